@@ -0,0 +1,166 @@
+import json
+import sqlite3
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+
+class AssociationCache():
+    # Parent/child associations per company id, kept in an LRU with a TTL and
+    # optionally written through to SQLite so it survives between runs. The tool
+    # applies its own detaches, merges and reattaches to the cached graph, so the
+    # entries never fall behind the changes made through this cache.
+    def __init__(self, ttl=3600, max_entries=100000, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "updates": 0}
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS associations (
+                    company_id TEXT PRIMARY KEY,
+                    child_companies TEXT NOT NULL,
+                    parent_companies TEXT NOT NULL,
+                    loaded_at REAL NOT NULL
+                )""")
+            self.connection.execute("DELETE FROM associations WHERE loaded_at < ?", (time.time() - self.ttl,))
+
+    def get(self, company_id):
+        company_id = str(company_id)
+        with self.lock:
+            entry = self.entries.get(company_id) or self.read_stored(company_id)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if time.time() - entry["loaded_at"] > self.ttl:
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                self.remove(company_id)
+                return None
+            self.stats["hits"] += 1
+            self.entries[company_id] = entry
+            self.entries.move_to_end(company_id)
+            self.evict()
+            return {"child_companies": list(entry["child_companies"]), "parent_companies": list(entry["parent_companies"])}
+
+    def put(self, company_id, associations, loaded_at=None):
+        company_id = str(company_id)
+        entry = {
+            "child_companies": list(dict.fromkeys(int(child_id) for child_id in associations["child_companies"])),
+            "parent_companies": list(dict.fromkeys(int(parent_id) for parent_id in associations["parent_companies"])),
+            "loaded_at": loaded_at or time.time()
+        }
+        with self.lock:
+            self.entries[company_id] = entry
+            self.entries.move_to_end(company_id)
+            self.write_stored(company_id, entry)
+            self.evict()
+
+    def contains(self, company_id):
+        # Like get(), an expired entry does not count, so it is loaded again with the
+        # batch it is checked for
+        company_id = str(company_id)
+        with self.lock:
+            entry = self.entries.get(company_id) or self.read_stored(company_id)
+            return entry is not None and time.time() - entry["loaded_at"] <= self.ttl
+
+    def remove(self, company_id):
+        company_id = str(company_id)
+        with self.lock:
+            self.entries.pop(company_id, None)
+            if self.connection:
+                self.connection.execute("DELETE FROM associations WHERE company_id = ?", (company_id,))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.connection:
+                self.connection.execute("DELETE FROM associations")
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def read_stored(self, company_id):
+        if not self.connection:
+            return None
+        row = self.connection.execute(
+            "SELECT child_companies, parent_companies, loaded_at FROM associations WHERE company_id = ?", (company_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"child_companies": json.loads(row[0]), "parent_companies": json.loads(row[1]), "loaded_at": row[2]}
+
+    def write_stored(self, company_id, entry):
+        if self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO associations (company_id, child_companies, parent_companies, loaded_at) VALUES (?, ?, ?, ?)",
+                (company_id, json.dumps(entry["child_companies"]), json.dumps(entry["parent_companies"]), entry["loaded_at"])
+            )
+
+    # Changes made by the tool. Edges are (child_id, parent_id) pairs.
+    def apply_detach(self, edges):
+        with self.lock:
+            for child_id, parent_id in edges:
+                self.update(child_id, lambda entry, parent_id=int(parent_id): self.discard(entry["parent_companies"], parent_id))
+                self.update(parent_id, lambda entry, child_id=int(child_id): self.discard(entry["child_companies"], child_id))
+
+    def apply_attach(self, edges):
+        with self.lock:
+            for child_id, parent_id in edges:
+                self.update(child_id, lambda entry, parent_id=int(parent_id): self.append(entry["parent_companies"], parent_id))
+                self.update(parent_id, lambda entry, child_id=int(child_id): self.append(entry["child_companies"], child_id))
+
+    def apply_merge(self, source_company_id, target_company_id):
+        # The merged company's remaining edges move to the company it was merged into
+        source_company_id, target_company_id = str(source_company_id), str(target_company_id)
+        with self.lock:
+            source = self.entries.get(source_company_id) or self.read_stored(source_company_id)
+            if source is None:
+                # Without the merged company's edges its neighbours cannot be found
+                logging.info(f"Association cache cleared: merged company {source_company_id} was not cached")
+                self.clear()
+                return
+            self.remove(source_company_id)
+            edges = [(child_id, target_company_id) for child_id in source["child_companies"] if str(child_id) != target_company_id]
+            edges += [(target_company_id, parent_id) for parent_id in source["parent_companies"] if str(parent_id) != target_company_id]
+            self.apply_detach([(child_id, source_company_id) for child_id in source["child_companies"]])
+            self.apply_detach([(source_company_id, parent_id) for parent_id in source["parent_companies"]])
+            self.apply_attach(edges)
+
+    def update(self, company_id, change):
+        company_id = str(company_id)
+        entry = self.entries.get(company_id) or self.read_stored(company_id)
+        if entry is None:
+            return
+        change(entry)
+        self.stats["updates"] += 1
+        self.entries[company_id] = entry
+        self.write_stored(company_id, entry)
+        self.evict()
+
+    def discard(self, company_ids, company_id):
+        if company_id in company_ids:
+            company_ids.remove(company_id)
+
+    def append(self, company_ids, company_id):
+        if company_id not in company_ids:
+            company_ids.append(company_id)
+
+    def summary(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            hit_rate = self.stats["hits"] / lookups if lookups else 0
+            return f"{self.stats['hits']} hits, {self.stats['misses']} misses ({hit_rate:.0%} hit rate), {self.stats['expired']} expired, {self.stats['evictions']} evictions, {len(self.entries)} entries"
+
+    def close(self):
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
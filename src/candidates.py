@@ -0,0 +1,330 @@
+import os
+import re
+import csv
+import json
+import logging
+import argparse
+import unicodedata
+import multiprocessing
+from array import array
+from clustering import UnionFind
+from validate_csv import ValidateCSV
+
+# Finds likely duplicate companies in a company export (CSV or JSON Lines with an
+# id, a name and optionally a domain) and writes them as merge input
+# (id,company_name,key,action) for main.py.
+#
+# Companies are only compared with the companies they share a block with: the
+# same normalized domain, a name word, two consecutive name words or the first
+# letters of the name. Blocks with more than max_block_size companies ("group",
+# "holdings") say little about a pair and are left out, so the work grows with
+# the number of companies, not with its square. The candidates are scored in
+# several processes.
+#
+#   python candidates.py companies.csv --output input_data.csv
+#   python candidates.py companies.jsonl --output input_data.csv --clusters --scores scores.jsonl
+
+ID_FIELDS = ("id", "hs_object_id", "record id", "company id")
+NAME_FIELDS = ("name", "company_name", "company name")
+DOMAIN_FIELDS = ("domain", "company domain name", "website", "website url")
+
+# Words that do not tell two companies apart
+NAME_STOP_WORDS = {
+    "the", "and", "of", "inc", "incorporated", "llc", "llp", "lp", "ltd", "limited", "corp", "corporation", "co", "company",
+    "plc", "gmbh", "ag", "sa", "sas", "sarl", "srl", "spa", "bv", "nv", "oy", "ab", "as", "kg", "pty", "pte"
+}
+# Domains of mail and site providers that many unrelated companies use
+SHARED_DOMAINS = {"gmail.com", "yahoo.com", "hotmail.com", "outlook.com", "aol.com", "icloud.com", "wordpress.com", "wixsite.com"}
+NAME_PREFIX_LENGTH = 5
+SCORE_CHUNK_SIZE = 5000
+
+
+def normalize_name(name):
+    name = unicodedata.normalize("NFKD", name or "").encode("ascii", "ignore").decode("ascii").lower()
+    name = name.replace("&", " and ")
+    tokens = re.findall(r"[a-z0-9]+", name)
+    return " ".join(token for token in tokens if token not in NAME_STOP_WORDS)
+
+
+def normalize_domain(domain):
+    domain = (domain or "").strip().lower()
+    domain = re.sub(r"^[a-z]+://", "", domain)
+    domain = re.split(r"[/?#:]", domain, maxsplit=1)[0]
+    if domain.startswith("www."):
+        domain = domain[4:]
+    if "." not in domain or domain in SHARED_DOMAINS:
+        return ""
+    return domain
+
+
+def name_trigrams(normalized_name):
+    compact = f"  {normalized_name.replace(' ', '')} "
+    return {compact[i:i + 3] for i in range(len(compact) - 2)}
+
+
+def jaccard(first, second):
+    if not first or not second:
+        return 0.0
+    common = len(first & second)
+    return common / (len(first) + len(second) - common)
+
+
+def blocking_keys(normalized_name, domain):
+    keys = set()
+    if domain:
+        keys.add("d:" + domain)
+    tokens = normalized_name.split()
+    keys.update("t:" + token for token in tokens if len(token) >= 3)
+    # Pairs of words still narrow a block down when each word alone is common
+    keys.update(f"b:{first} {second}" for first, second in zip(tokens, tokens[1:]))
+    compact = normalized_name.replace(" ", "")
+    if len(compact) >= NAME_PREFIX_LENGTH:
+        keys.add("p:" + compact[:NAME_PREFIX_LENGTH])
+    return keys
+
+
+def score_pair(first_trigrams, first_domain, second_trigrams, second_domain):
+    # Name similarity is the Jaccard index of the names' character trigrams. The
+    # same domain makes a pair likely even if the names are written differently,
+    # and two different domains make it less likely.
+    name_similarity = jaccard(first_trigrams, second_trigrams)
+    if first_domain and second_domain:
+        if first_domain == second_domain:
+            return 0.5 + 0.5 * name_similarity
+        return 0.8 * name_similarity
+    return name_similarity
+
+
+def read_companies(input_file):
+    # Yields (id, name, domain). JSON Lines records may keep the fields under
+    # "properties", as HubSpot API objects do.
+    with open(input_file, mode='r', encoding='utf-8') as file:
+        first_line = file.readline()
+        file.seek(0)
+        if first_line.lstrip().startswith("{"):
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record = dict(record.get("properties") or {}, **{k: v for k, v in record.items() if k != "properties"})
+                yield company_fields(record)
+        else:
+            for row in csv.DictReader(file):
+                yield company_fields(row)
+
+
+def company_fields(record):
+    record = {str(field).strip().lower(): value for field, value in record.items()}
+
+    def first_value(fields):
+        for field in fields:
+            if record.get(field) not in (None, ""):
+                return str(record[field]).strip()
+        return ""
+
+    company_id = first_value(ID_FIELDS)
+    if not company_id:
+        error_message = f"Company without an id in the export: {record}"
+        logging.error(error_message)
+        raise Exception(error_message)
+    return company_id, first_value(NAME_FIELDS), first_value(DOMAIN_FIELDS)
+
+
+class CompanyIndex():
+    # Normalized names and domains of all companies, by position, and the blocks:
+    # blocking key -> positions of the companies in it
+    def __init__(self, max_block_size=500):
+        self.max_block_size = max_block_size
+        self.ids = []
+        self.names = []
+        self.normalized_names = []
+        self.domains = []
+        self.blocks = {}
+
+    def add(self, company_id, name, domain):
+        position = len(self.ids)
+        normalized_name = normalize_name(name)
+        domain = normalize_domain(domain)
+        self.ids.append(company_id)
+        self.names.append(name)
+        self.normalized_names.append(normalized_name)
+        self.domains.append(domain)
+        for key in blocking_keys(normalized_name, domain):
+            block = self.blocks.get(key)
+            if block is None:
+                block = self.blocks[key] = array("I")
+            if len(block) <= self.max_block_size:
+                block.append(position)
+
+    def drop_large_blocks(self):
+        large_blocks = [key for key, block in self.blocks.items() if len(block) > self.max_block_size or len(block) < 2]
+        for key in large_blocks:
+            del self.blocks[key]
+        logging.info(f"Indexed {len(self.ids)} companies in {len(self.blocks)} blocks")
+
+    def candidates(self, position):
+        # Companies after this one that share a block with it, so every pair is
+        # looked at once
+        candidates = set()
+        for key in blocking_keys(self.normalized_names[position], self.domains[position]):
+            block = self.blocks.get(key)
+            if block is not None:
+                candidates.update(other for other in block if other > position)
+        return candidates
+
+    def score_range(self, start, end, threshold):
+        pairs = []
+        trigrams = {}
+        for position in range(start, end):
+            candidates = self.candidates(position)
+            if not candidates:
+                continue
+            position_trigrams = name_trigrams(self.normalized_names[position])
+            for other in candidates:
+                other_trigrams = trigrams.get(other)
+                if other_trigrams is None:
+                    other_trigrams = trigrams[other] = name_trigrams(self.normalized_names[other])
+                score = score_pair(position_trigrams, self.domains[position], other_trigrams, self.domains[other])
+                if score >= threshold:
+                    pairs.append((round(score, 4), position, other))
+            if len(trigrams) > 100000:
+                trigrams.clear()
+        return pairs
+
+
+# The index of the worker processes. With the fork start method it is inherited
+# instead of pickled.
+worker_index = None
+
+
+def init_worker(index):
+    global worker_index
+    worker_index = index
+
+
+def score_chunk(chunk):
+    start, end, threshold = chunk
+    return worker_index.score_range(start, end, threshold)
+
+
+def score_candidates(index, threshold, processes=None):
+    chunks = [(start, min(start + SCORE_CHUNK_SIZE, len(index.ids)), threshold) for start in range(0, len(index.ids), SCORE_CHUNK_SIZE)]
+    pairs = []
+    if processes == 1 or len(chunks) <= 1:
+        for start, end, threshold in chunks:
+            pairs.extend(index.score_range(start, end, threshold))
+        return pairs
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+    with context.Pool(processes=processes, initializer=init_worker, initargs=(index,)) as pool:
+        for chunk_number, chunk_pairs in enumerate(pool.imap_unordered(score_chunk, chunks), start=1):
+            pairs.extend(chunk_pairs)
+            if chunk_number % 20 == 0 or chunk_number == len(chunks):
+                logging.info(f"Scored {chunk_number}/{len(chunks)} chunks, {len(pairs)} candidate pairs so far")
+    return pairs
+
+
+def survivor_order(index, position):
+    # The company that is kept: one with a domain, then the oldest (lowest) id
+    company_id = index.ids[position]
+    return (0 if index.domains[position] else 1, 0 if company_id.isdigit() else 1, int(company_id) if company_id.isdigit() else 0, company_id)
+
+
+def select_pairs(index, pairs):
+    # Best pairs first; a company is in at most one pair
+    used = set()
+    selected = []
+    for score, first, second in sorted(pairs, key=lambda pair: (-pair[0], pair[1], pair[2])):
+        if first in used or second in used:
+            continue
+        used.update((first, second))
+        keep, merge = sorted((first, second), key=lambda position: survivor_order(index, position))
+        selected.append((score, keep, merge))
+    return selected
+
+
+def select_clusters(index, pairs, max_cluster_size=20):
+    # Every pair above the threshold joins the companies' clusters. Each cluster
+    # is written as one keep/merge pair per merged company, all with the same
+    # survivor, which main.py --clusters merges as one cluster.
+    union_find = UnionFind()
+    best_scores = {}
+    for score, first, second in pairs:
+        union_find.union(first, second)
+        best_scores[first] = max(best_scores.get(first, 0), score)
+        best_scores[second] = max(best_scores.get(second, 0), score)
+    members = {}
+    for position in best_scores:
+        members.setdefault(union_find.find(position), []).append(position)
+    selected = []
+    for cluster in sorted(members.values(), key=min):
+        if len(cluster) > max_cluster_size:
+            logging.warning(f"Skipping a cluster of {len(cluster)} companies (more than {max_cluster_size}), starting with "
+                            f"{', '.join(index.ids[position] for position in sorted(cluster)[:5])}")
+            continue
+        cluster.sort(key=lambda position: survivor_order(index, position))
+        survivor = cluster[0]
+        selected.extend((best_scores[position], survivor, position) for position in cluster[1:])
+    return selected
+
+
+def write_merge_input(index, selected, output_file, scores_file=None):
+    rows = []
+    for key_number, (score, keep, merge) in enumerate(selected, start=1):
+        rows.append({"id": index.ids[keep], "company_name": index.names[keep], "key": str(key_number), "action": "keep"})
+        rows.append({"id": index.ids[merge], "company_name": index.names[merge], "key": str(key_number), "action": "merge"})
+    with open(output_file, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=["id", "company_name", "key", "action"])
+        writer.writeheader()
+        writer.writerows(rows)
+    if scores_file:
+        with open(scores_file, "w", encoding="utf-8") as file:
+            for key_number, (score, keep, merge) in enumerate(selected, start=1):
+                file.write(json.dumps({
+                    "key": str(key_number), "score": score,
+                    "keep": {"id": index.ids[keep], "name": index.names[keep], "domain": index.domains[keep]},
+                    "merge": {"id": index.ids[merge], "name": index.names[merge], "domain": index.domains[merge]}
+                }) + "\n")
+    return rows
+
+
+def generate_candidates(input_file, output_file, threshold=0.8, clusters=False, processes=None, max_block_size=500,
+                        max_cluster_size=20, scores_file=None):
+    index = CompanyIndex(max_block_size=max_block_size)
+    for company_id, name, domain in read_companies(input_file):
+        index.add(company_id, name, domain)
+    index.drop_large_blocks()
+
+    pairs = score_candidates(index, threshold, processes)
+    if clusters:
+        selected = select_clusters(index, pairs, max_cluster_size)
+    else:
+        selected = select_pairs(index, pairs)
+    rows = write_merge_input(index, selected, output_file, scores_file)
+
+    # The output has to be accepted by main.py as it is
+    validator = ValidateCSV(allow_chains=clusters)
+    for row_number, row in enumerate(rows, start=2):
+        validator.add(row, row_number)
+    validator.finish()
+    logging.info(f"Wrote {len(selected)} merge pairs from {len(pairs)} candidate pairs to {output_file}")
+    return selected
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find likely duplicate companies in an export and write them as merge input")
+    parser.add_argument("input_file", help="CSV or JSON Lines export with id, name and domain of every company")
+    parser.add_argument("--output", default="./data/inputs/input_data.csv", help="Merge input file to write")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Lowest score (0 to 1) of a pair that is written")
+    parser.add_argument("--clusters", action="store_true", help="Group overlapping pairs into clusters (run main.py with --clusters)")
+    parser.add_argument("--processes", type=int, help="Number of scoring processes (default: one per CPU)")
+    parser.add_argument("--max-block-size", type=int, default=500, help="Blocks with more companies than this are not compared")
+    parser.add_argument("--max-cluster-size", type=int, default=20, help="With --clusters, larger clusters are skipped")
+    parser.add_argument("--scores", help="Also write every selected pair with its score to this JSON Lines file, for review")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    generate_candidates(args.input_file, args.output, threshold=args.threshold, clusters=args.clusters, processes=args.processes,
+                        max_block_size=args.max_block_size, max_cluster_size=args.max_cluster_size, scores_file=args.scores)
@@ -0,0 +1,72 @@
+class UnionFind():
+    def __init__(self):
+        self.parent = {}
+        self.rank = {}
+
+    def find(self, item):
+        self.parent.setdefault(item, item)
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, first, second):
+        first_root, second_root = self.find(first), self.find(second)
+        if first_root == second_root:
+            return first_root
+        if self.rank.get(first_root, 0) < self.rank.get(second_root, 0):
+            first_root, second_root = second_root, first_root
+        self.parent[second_root] = first_root
+        if self.rank.get(first_root, 0) == self.rank.get(second_root, 0):
+            self.rank[first_root] = self.rank.get(first_root, 0) + 1
+        return first_root
+
+
+class MergeClusters():
+    # Groups pairwise merge rows (one keep and one merge per key) into clusters of
+    # companies that end up as one company, including chains such as A -> B, B -> C.
+    # Each cluster's survivor is the company that is kept and never merged.
+    def __init__(self):
+        self.union_find = UnionFind()
+        self.first_key = {}
+        self.names = {}
+        self.merged_ids = set()
+        self.kept_ids = set()
+        self.key_ids = {}
+
+    def add_row(self, row):
+        company_id = row['id']
+        self.names.setdefault(company_id, row['company_name'])
+        self.first_key.setdefault(company_id, row['key'])
+        if row['action'] == 'merge':
+            self.merged_ids.add(company_id)
+        else:
+            self.kept_ids.add(company_id)
+        key_first_id = self.key_ids.setdefault(row['key'], company_id)
+        self.union_find.union(key_first_id, company_id)
+
+    def grouped_data(self):
+        members = {}
+        for company_id in self.first_key:
+            members.setdefault(self.union_find.find(company_id), []).append(company_id)
+
+        key_order = {key: index for index, key in enumerate(self.key_ids)}
+        grouped_data = {}
+        errors = []
+        for cluster_ids in members.values():
+            cluster_key = min((self.first_key[company_id] for company_id in cluster_ids), key=key_order.get)
+            survivors = [company_id for company_id in cluster_ids if company_id in self.kept_ids and company_id not in self.merged_ids]
+            if len(survivors) != 1:
+                error_message = f"Merge cluster of key {cluster_key} ({', '.join(cluster_ids)}) has {len(survivors)} companies that are only kept; it needs exactly one."
+                errors.append({"row": None, "key": cluster_key, "rule": "single_survivor_per_cluster", "message": error_message})
+                continue
+            grouped_data[cluster_key] = [
+                {"id": company_id, "company_name": self.names[company_id], "key": cluster_key, "action": "keep" if company_id == survivors[0] else "merge"}
+                for company_id in [survivors[0]] + [company_id for company_id in cluster_ids if company_id != survivors[0]]
+            ]
+        # Clusters in the order their first key appears in the input
+        grouped_data = dict(sorted(grouped_data.items(), key=lambda item: key_order[item[0]]))
+        return grouped_data, errors
@@ -0,0 +1,192 @@
+import logging
+from array import array
+from collections.abc import Mapping
+from records import KeyRowsView
+
+# Parquet, Arrow IPC (Feather) and gzip CSV input, read with pyarrow. Parquet and
+# Arrow files are memory-mapped, the rows are put in key order and checked with
+# Arrow compute functions, and rows only become Python dicts one key at a time,
+# as run_merge reads them. pyarrow is only needed for these inputs:
+#
+#   pip install pyarrow
+
+FIELDS = ["id", "company_name", "key", "action"]
+PARQUET_SUFFIXES = (".parquet", ".pq")
+ARROW_SUFFIXES = (".arrow", ".feather", ".ipc")
+CSV_SUFFIXES = (".csv.gz", ".csv.bz2")
+
+
+def is_columnar_input(path):
+    return str(path).lower().endswith(PARQUET_SUFFIXES + ARROW_SUFFIXES + CSV_SUFFIXES)
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        error_message = "Parquet, Arrow and compressed CSV input needs pyarrow: pip install pyarrow"
+        logging.error(error_message)
+        raise Exception(error_message)
+    return pyarrow
+
+
+def read_table(path):
+    # The four input columns as strings (missing values become ""), with the
+    # action lowercased and the row number each row would have in a CSV file
+    pa = import_pyarrow()
+    pc = pa.compute
+    lower_path = str(path).lower()
+    if lower_path.endswith(PARQUET_SUFFIXES):
+        schema_names = pa.parquet.read_schema(path).names
+        check_columns(path, schema_names)
+        table = pa.parquet.read_table(path, columns=FIELDS, memory_map=True)
+    elif lower_path.endswith(ARROW_SUFFIXES):
+        source = pa.memory_map(str(path), "r")
+        try:
+            table = pa.ipc.open_file(source).read_all()
+        except pa.ArrowInvalid:
+            source.seek(0)
+            table = pa.ipc.open_stream(source).read_all()
+        check_columns(path, table.column_names)
+    else:
+        # The compression is taken from the file extension
+        table = pa.csv.read_csv(path, convert_options=pa.csv.ConvertOptions(column_types={field: pa.string() for field in FIELDS}))
+        check_columns(path, table.column_names)
+
+    columns = {}
+    for field in FIELDS:
+        column = table.column(field)
+        if column.type != pa.string():
+            column = pc.cast(column, pa.string())
+        columns[field] = column.fill_null("")
+    columns["action"] = pc.utf8_lower(columns["action"])
+    columns["row_number"] = pa.array(range(2, table.num_rows + 2), type=pa.int64())
+    return pa.table(columns)
+
+
+def check_columns(path, names):
+    missing = [field for field in FIELDS if field not in names]
+    if missing:
+        error_message = f"Input file {path} has no {', '.join(missing)} column"
+        logging.error(error_message)
+        raise Exception(error_message)
+
+
+def read_rows(path, batch_size=10000):
+    # Rows as dicts in file order, a batch at a time
+    table = read_table(path).select(FIELDS)
+    for batch in table.to_batches(max_chunksize=batch_size):
+        yield from batch.to_pylist()
+
+
+class ColumnarInput(Mapping):
+    # Key -> rows of a columnar input file, like RecordStore. Keys keep the order
+    # in which they first appear; the rows of the i-th key are key_starts[i] to
+    # key_starts[i + 1] of the table.
+    def __init__(self, path):
+        pa = import_pyarrow()
+        pc = pa.compute
+        self.path = path
+        table = read_table(path)
+        # dictionary_encode numbers the keys in order of first appearance, and a
+        # stable sort by that number groups the rows without reordering a key's rows
+        encoded_keys = pc.dictionary_encode(table.column("key").combine_chunks())
+        self.keys_in_order = encoded_keys.dictionary
+        self.table = table.take(pc.sort_indices(encoded_keys.indices))
+        key_counts = pc.value_counts(encoded_keys.indices)
+        counts = key_counts.field("counts").take(pc.sort_indices(key_counts.field("values")))
+        self.key_starts = array("Q", [0])
+        if len(counts):
+            self.key_starts.extend(pc.cumulative_sum(counts).to_pylist())
+        self.key_positions = None
+        logging.info(f"Read {self.table.num_rows} rows in {len(self.keys_in_order)} keys from {path}")
+
+    def rows(self, position):
+        start = self.key_starts[position]
+        return self.table.slice(start, self.key_starts[position + 1] - start).select(FIELDS).to_pylist()
+
+    def items(self):
+        return KeyRowsView(self)
+
+    def iter_items(self):
+        for position, key in enumerate(self.keys_in_order):
+            yield key.as_py(), self.rows(position)
+
+    def __getitem__(self, key):
+        if self.key_positions is None:
+            self.key_positions = {key: position for position, key in enumerate(self.keys_in_order.to_pylist())}
+        return self.rows(self.key_positions[key])
+
+    def __iter__(self):
+        return (key.as_py() for key in self.keys_in_order)
+
+    def __len__(self):
+        return len(self.keys_in_order)
+
+    @property
+    def row_count(self):
+        return self.table.num_rows
+
+    def validate(self, validator):
+        # The ValidateCSV rules on whole columns. Only the rows and keys that break a
+        # rule become Python objects; errors go to validator in row order, with the
+        # per-key errors after the row errors.
+        pa = import_pyarrow()
+        pc = pa.compute
+        table = self.table
+        row_errors = []
+
+        def record(row):
+            return {field: row[field] for field in FIELDS}
+
+        # Rows equal to an earlier row once their values are stripped
+        stripped = pa.table(dict({field: pc.utf8_trim_whitespace(table.column(field)) for field in FIELDS}, row_number=table.column("row_number")))
+        groups = stripped.group_by(FIELDS).aggregate([("row_number", "min"), ("row_number", "count")])
+        duplicate_groups = groups.filter(pc.greater(groups.column("row_number_count"), 1)).select(FIELDS + ["row_number_min"])
+        if duplicate_groups.num_rows:
+            duplicates = table.join(stripped.join(duplicate_groups, keys=FIELDS, join_type="inner").select(["row_number", "row_number_min"]),
+                                    keys="row_number", join_type="inner")
+            duplicates = duplicates.filter(pc.greater(duplicates.column("row_number"), duplicates.column("row_number_min")))
+            for row in duplicates.to_pylist():
+                row_errors.append((row["row_number"], "no_duplicate_records", f"Duplicate record found: {record(row)}", row["key"]))
+
+        is_keep = pc.equal(table.column("action"), "keep")
+        is_merge = pc.equal(table.column("action"), "merge")
+        invalid_actions = table.filter(pc.invert(pc.or_(is_keep, is_merge)))
+        for row in invalid_actions.to_pylist():
+            row_errors.append((row["row_number"], "action_has_correct_values", f"Invalid action '{row['action']}' in record: {record(row)}", row["key"]))
+
+        if not validator.allow_chains:
+            # A keep row whose id was merged in an earlier row, and the other way round
+            keep_rows = table.filter(is_keep).select(["id", "key", "row_number"])
+            merge_rows = table.filter(is_merge).select(["id", "key", "row_number"])
+            for rows, earlier_rows, earlier_action in ((keep_rows, merge_rows, "merge"), (merge_rows, keep_rows, "keep")):
+                first_rows = earlier_rows.group_by("id").aggregate([("row_number", "min")])
+                overlaps = rows.join(first_rows, keys="id", join_type="inner")
+                overlaps = overlaps.filter(pc.greater(overlaps.column("row_number"), overlaps.column("row_number_min")))
+                for row in overlaps.to_pylist():
+                    row_errors.append((row["row_number"], "no_keep_merge_id_overlap", f"ID {row['id']} is used as '{earlier_action}' in another key.", row["key"]))
+
+        for row_number, rule, message, key in sorted(row_errors):
+            validator.report(rule, message, key, row_number)
+
+        # Keys without exactly one keep and one merge row
+        counts = pa.table({
+            "key": table.column("key"),
+            "keep": pc.cast(is_keep, pa.int64()),
+            "merge": pc.cast(is_merge, pa.int64())
+        }).group_by("key").aggregate([("keep", "sum"), ("merge", "sum"), ("keep", "count")])
+        broken = pc.or_(pc.or_(pc.not_equal(counts.column("keep_sum"), 1), pc.not_equal(counts.column("merge_sum"), 1)),
+                        pc.not_equal(counts.column("keep_count"), 2))
+        broken_keys = {row["key"]: row for row in counts.filter(broken).to_pylist()}
+        for key in self.keys_in_order.to_pylist() if broken_keys else []:
+            if key in broken_keys:
+                row = broken_keys[key]
+                key_counts = {"keep": row["keep_sum"], "merge": row["merge_sum"], "rows": row["keep_count"]}
+                validator.validate_csv__merge_mapped_to_single_keep(key, key_counts)
+                validator.validate_csv__each_key_has_two_records(key, key_counts)
+                validator.validate_csv__keys_have_merge_and_keep(key, key_counts)
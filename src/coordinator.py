@@ -0,0 +1,232 @@
+import os
+import csv
+import json
+import time
+import zlib
+import queue
+import shutil
+import logging
+import argparse
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from main import HubspotAPI
+from journal import MergeJournal
+from validate_csv import ValidateCSV
+
+# Runs merges for several portals at once from a manifest such as:
+#
+# {"jobs": [
+#     {"portal": "acme", "token_env": "ACME_TOKEN", "input_file": "acme.csv", "shards": 2, "workers": 4},
+#     {"portal": "globex", "token_file": "globex.token", "input_file": "globex.csv"}
+# ]}
+#
+# Every shard of every job runs in its own process. A large input is split into
+# shards by key, and all shards of a token share one request budget
+# (rate_limit requests per rate_interval seconds, HubSpot's default burst limit
+# unless the job says otherwise).
+
+DEFAULT_RATE_LIMIT = 100
+DEFAULT_RATE_INTERVAL = 10
+
+
+class SharedRateLimiter():
+    # Token bucket kept in a multiprocessing manager, so every process using the
+    # same access token draws from the same budget
+    def __init__(self, manager, rate_limit=DEFAULT_RATE_LIMIT, rate_interval=DEFAULT_RATE_INTERVAL):
+        self.rate = rate_limit / rate_interval
+        self.capacity = rate_limit
+        self.lock = manager.Lock()
+        self.state = manager.dict({"tokens": float(rate_limit), "updated_at": time.monotonic()})
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens = min(self.capacity, self.state["tokens"] + (now - self.state["updated_at"]) * self.rate)
+                if tokens >= 1:
+                    self.state.update({"tokens": tokens - 1, "updated_at": now})
+                    return
+                self.state.update({"tokens": tokens, "updated_at": now})
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
+def load_manifest(manifest_path):
+    with open(manifest_path, mode='r', encoding='utf-8') as file:
+        manifest = json.load(file)
+    base_directory = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = manifest["jobs"] if isinstance(manifest, dict) else manifest
+    for job in jobs:
+        if "token" not in job:
+            if "token_env" in job:
+                job["token"] = os.getenv(job["token_env"])
+            elif "token_file" in job:
+                with open(os.path.join(base_directory, job["token_file"]), mode='r', encoding='utf-8') as file:
+                    job["token"] = file.read().strip()
+        if not job.get("token"):
+            raise Exception(f"No access token for portal {job['portal']}")
+        job["input_file"] = os.path.join(base_directory, job["input_file"])
+    return jobs
+
+
+def validate_input(input_file):
+    # The whole file is validated before it is split, so overlaps between keys
+    # that end up in different shards are still found
+    validator = ValidateCSV()
+    with open(input_file, mode='r', encoding='utf-8') as file:
+        for row_number, row in enumerate(csv.DictReader(file), start=2):
+            row['action'] = row['action'].lower()
+            validator.add(row, row_number)
+    validator.finish()
+
+
+def split_input(input_file, shard_directory, shards):
+    # Rows of a key always go to the same shard
+    os.makedirs(shard_directory, exist_ok=True)
+    shard_paths = [os.path.join(shard_directory, f"shard_{i}.csv") for i in range(shards)]
+    with open(input_file, mode='r', encoding='utf-8') as file:
+        reader = csv.DictReader(file)
+        shard_files = [open(path, "w", newline="", encoding="utf-8") for path in shard_paths]
+        try:
+            writers = [csv.DictWriter(shard_file, fieldnames=reader.fieldnames) for shard_file in shard_files]
+            for writer in writers:
+                writer.writeheader()
+            for row in reader:
+                writers[zlib.crc32(row["key"].encode("utf-8")) % shards].writerow(row)
+        finally:
+            for shard_file in shard_files:
+                shard_file.close()
+    return shard_paths
+
+
+def run_shard(shard, rate_limiter, progress_queue):
+    output_dir = shard["output_dir"]
+    for directory in ("intermediate", "outputs", "errors", "journal"):
+        os.makedirs(os.path.join(output_dir, directory), exist_ok=True)
+    logging.basicConfig(filename=os.path.join(output_dir, "merge_operations.log"),
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    def progress(key, status):
+        progress_queue.put((shard["portal"], status))
+
+    hubspot_client = HubspotAPI(api_key=shard["token"], input_file_path=shard["input_file"], max_workers=shard.get("workers", 1),
+                                output_dir=output_dir, rate_limiter=rate_limiter, base_url=shard.get("base_url", "https://api.hubapi.com"))
+    journal = MergeJournal(os.path.join(output_dir, "journal", "journal.sqlite"), resume=shard.get("resume", False))
+    try:
+        hubspot_client.run_merge(hubspot_client.iter_grouped_data(), journal=journal, collect_results=False, progress=progress)
+    finally:
+        journal.close()
+    # The files this run wrote. A resumed run writes every key again, including the
+    # ones an earlier run's files already have.
+    outputs = {"pre_merge": hubspot_client.intermediate_writer.path, "merged": hubspot_client.results_writer.path,
+               "missing": hubspot_client.missing_writer.path}
+    return {"portal": shard["portal"], "shard": shard["shard"], "output_dir": output_dir, "missing": len(hubspot_client.missing), "outputs": outputs}
+
+
+def combine_outputs(portal_directory, shard_results):
+    # Concatenate the JSON Lines files the shards wrote in this run into one file
+    # per output kind. A shard's writer only creates its file on the first record.
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    combined = {}
+    for prefix in ("pre_merge", "merged", "missing"):
+        combined_path = os.path.join(portal_directory, f"{prefix}_{timestamp}.jsonl")
+        with open(combined_path, "wb") as combined_file:
+            for result in sorted(shard_results, key=lambda result: result["shard"]):
+                shard_path = result["outputs"][prefix]
+                if os.path.exists(shard_path):
+                    with open(shard_path, "rb") as shard_file:
+                        shutil.copyfileobj(shard_file, combined_file)
+        combined[prefix] = combined_path
+    return combined
+
+
+def report_progress(progress_queue, stop, interval=10):
+    counts = {}
+    last_report = time.monotonic()
+    while not stop.is_set() or not progress_queue.empty():
+        try:
+            portal, status = progress_queue.get(timeout=1)
+            portal_counts = counts.setdefault(portal, {"merged": 0, "missing": 0})
+            portal_counts[status] += 1
+        except queue.Empty:
+            pass
+        if time.monotonic() - last_report >= interval:
+            last_report = time.monotonic()
+            logging.info("Progress: " + ", ".join(f"{portal} {c['merged']} merged / {c['missing']} missing" for portal, c in sorted(counts.items())))
+    return counts
+
+
+def run_manifest(manifest_path, output_dir="./data/portals", processes=None, resume=False):
+    jobs = load_manifest(manifest_path)
+    manager = multiprocessing.Manager()
+    progress_queue = manager.Queue()
+
+    # One limiter per access token, shared by every shard using it
+    rate_limiters = {}
+    shards = []
+    for job in jobs:
+        if job["token"] not in rate_limiters:
+            rate_limiters[job["token"]] = SharedRateLimiter(manager, job.get("rate_limit", DEFAULT_RATE_LIMIT), job.get("rate_interval", DEFAULT_RATE_INTERVAL))
+        portal_directory = os.path.join(output_dir, job["portal"])
+        validate_input(job["input_file"])
+        shard_count = job.get("shards", 1)
+        if shard_count > 1:
+            input_files = split_input(job["input_file"], os.path.join(portal_directory, "shard_inputs"), shard_count)
+        else:
+            input_files = [job["input_file"]]
+        for shard_number, input_file in enumerate(input_files):
+            shards.append(dict(job, input_file=input_file, shard=shard_number, resume=resume,
+                               output_dir=os.path.join(portal_directory, f"shard_{shard_number}")))
+
+    stop = threading.Event()
+    progress_thread = threading.Thread(target=report_progress, args=(progress_queue, stop), daemon=True)
+    progress_thread.start()
+
+    results = {}
+    errors = []
+    with ProcessPoolExecutor(max_workers=processes or len(shards)) as executor:
+        futures = {executor.submit(run_shard, shard, rate_limiters[shard["token"]], progress_queue): shard for shard in shards}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                result = future.result()
+                results.setdefault(shard["portal"], []).append(result)
+                logging.info(f"Portal {shard['portal']} shard {shard['shard']} finished")
+            except Exception as e:
+                errors.append({"portal": shard["portal"], "shard": shard["shard"], "error": str(e)})
+                logging.error(f"Portal {shard['portal']} shard {shard['shard']} failed: {e}")
+
+    stop.set()
+    progress_thread.join()
+
+    summary = {"portals": {}, "errors": errors}
+    for portal, shard_results in results.items():
+        summary["portals"][portal] = {
+            "shards": len(shard_results),
+            "missing": sum(result["missing"] for result in shard_results),
+            "outputs": combine_outputs(os.path.join(output_dir, portal), shard_results)
+        }
+    with open(os.path.join(output_dir, f"summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"), 'w', encoding='utf-8') as file:
+        json.dump(summary, file, indent=2)
+    manager.shutdown()
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run Hubspot merges for several portals in parallel processes")
+    parser.add_argument("manifest", help="JSON manifest of portal, token and input file jobs")
+    parser.add_argument("--output-dir", default="./data/portals", help="Directory for the per-portal outputs")
+    parser.add_argument("--processes", type=int, help="Number of processes (default: one per shard)")
+    parser.add_argument("--resume", action="store_true", help="Continue interrupted shards from their journals")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    summary = run_manifest(args.manifest, output_dir=args.output_dir, processes=args.processes, resume=args.resume)
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,122 @@
+import csv
+import json
+import queue
+import itertools
+import os
+import threading
+import zlib
+
+
+def key_sort_value(key):
+    # Numeric keys sort as numbers, so 1, 2, 10 counts as sorted
+    return (0, int(key), "") if key.isdigit() else (1, 0, key)
+
+
+def iter_contiguous_groups(rows):
+    # Rows of a key must be next to each other; each group is yielded as soon as
+    # the next key starts
+    current_key = None
+    group = []
+    for row in rows:
+        if group and row["key"] != current_key:
+            yield current_key, group
+            group = []
+        current_key = row["key"]
+        group.append(row)
+    if group:
+        yield current_key, group
+
+
+def read_stream_rows(stream, input_format=None):
+    # Rows from an open text stream such as stdin: CSV with a header row, or JSON
+    # Lines. Without input_format, the first line decides. Rows are yielded as
+    # their lines arrive.
+    first_line = stream.readline()
+    if not first_line:
+        return
+    if input_format is None:
+        input_format = "jsonl" if first_line.lstrip().startswith("{") else "csv"
+    lines = itertools.chain([first_line], stream)
+    if input_format == "csv":
+        rows = csv.DictReader(lines)
+    else:
+        rows = (json.loads(line) for line in lines if line.strip())
+    for row in rows:
+        row = {field: str(value) for field, value in row.items()}
+        row["action"] = row.get("action", "").lower()
+        yield row
+
+
+def partition_rows(rows, fieldnames, directory, partitions=64):
+    # Hash-partition the rows into files by key, so a partition can be grouped in
+    # memory on its own and only 1/partitions of the input is loaded at once
+    paths = [os.path.join(directory, f"partition_{i}.csv") for i in range(partitions)]
+    files = [open(path, "w", newline="", encoding="utf-8") for path in paths]
+    try:
+        writers = [csv.DictWriter(file, fieldnames=fieldnames) for file in files]
+        for writer in writers:
+            writer.writeheader()
+        for row in rows:
+            writers[zlib.crc32(row["key"].encode("utf-8")) % partitions].writerow(row)
+    finally:
+        for file in files:
+            file.close()
+    return paths
+
+
+def iter_partition_groups(paths):
+    for path in paths:
+        grouped_data = {}
+        with open(path, mode="r", encoding="utf-8") as file:
+            for row in csv.DictReader(file):
+                grouped_data.setdefault(row["key"], []).append(row)
+        yield from grouped_data.items()
+
+
+def iter_windows(items, window_size):
+    items = iter(items)
+    while True:
+        window = list(itertools.islice(items, window_size))
+        if not window:
+            return
+        yield window
+
+
+class KeyQueue():
+    # Groups read by a background thread, e.g. from a pipe. windows() hands out the
+    # keys that have arrived so far, up to window_size, instead of waiting for a
+    # full window.
+    def __init__(self, groups, max_size=10000):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.read, args=(groups,), name="key-reader", daemon=True)
+        self.thread.start()
+
+    def read(self, groups):
+        try:
+            for item in groups:
+                self.queue.put(item)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(None)
+
+    def windows(self, window_size):
+        finished = False
+        while not finished:
+            item = self.queue.get()
+            if item is None:
+                break
+            window = [item]
+            while len(window) < window_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    finished = True
+                    break
+                window.append(item)
+            yield window
+        if self.error:
+            raise self.error
@@ -0,0 +1,81 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+KEY_PHASES = ["enriched", "detached", "merged", "reattached"]
+
+
+class MergeJournal():
+    # Append-only record of the phases each key has completed, so an interrupted
+    # run can be resumed. WAL mode keeps each commit to a single sequential write.
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS key_phases (
+                key TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                data TEXT,
+                recorded_at TEXT NOT NULL,
+                PRIMARY KEY (key, phase)
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS merged_companies (
+                company_id TEXT PRIMARY KEY,
+                into_company_id TEXT NOT NULL,
+                key TEXT NOT NULL
+            )""")
+        if not resume:
+            self.connection.execute("DELETE FROM key_phases")
+            self.connection.execute("DELETE FROM merged_companies")
+
+    def record(self, key, phase, data=None):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO key_phases (key, phase, data, recorded_at) VALUES (?, ?, ?, ?)",
+                (str(key), phase, json.dumps(data) if data is not None else None, datetime.now().isoformat())
+            )
+
+    def record_merge(self, key, company_id, into_company_id):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO merged_companies (company_id, into_company_id, key) VALUES (?, ?, ?)",
+                (str(company_id), str(into_company_id), str(key))
+            )
+
+    def load_keys(self, keys):
+        # Recorded phases of many keys at once: {key: {phase: data}}
+        states = {}
+        keys = [str(key) for key in keys]
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.connection.execute(f"SELECT key, phase, data FROM key_phases WHERE key IN ({placeholders})", batch)
+                for key, phase, data in rows:
+                    states.setdefault(key, {})[phase] = json.loads(data) if data is not None else None
+        return states
+
+    def iter_phase(self, phase):
+        # (key, data) of every key that recorded the phase, in the order recorded
+        with self.lock:
+            rows = self.connection.execute("SELECT key, data FROM key_phases WHERE phase = ? ORDER BY recorded_at", (phase,)).fetchall()
+        for key, data in rows:
+            yield key, json.loads(data) if data is not None else None
+
+    def merged_into(self):
+        # company id -> id of the company it was merged into
+        with self.lock:
+            return dict(self.connection.execute("SELECT company_id, into_company_id FROM merged_companies"))
+
+    def merged_company_ids(self):
+        with self.lock:
+            return {company_id for (company_id,) in self.connection.execute("SELECT company_id FROM merged_companies")}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
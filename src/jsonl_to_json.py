@@ -0,0 +1,27 @@
+import argparse
+import json
+import os
+from output_writer import read_jsonl
+
+# Converts the JSON Lines outputs of run_merge back into the JSON files earlier
+# versions wrote: a list with one entry per key, pretty-printed.
+
+def jsonl_to_json(input_path, output_path=None):
+    if output_path is None:
+        output_path = input_path[:-3] if input_path.endswith(".gz") else input_path
+        output_path = os.path.splitext(output_path)[0] + ".json"
+
+    # Pre-merge and merged records wrap the per-key list in "companies"; missing
+    # records are written as they are
+    data = [record["companies"] if "companies" in record else record for record in read_jsonl(input_path)]
+    with open(output_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2)
+    return output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert merge outputs from JSON Lines to JSON")
+    parser.add_argument("paths", nargs="+", help="JSONL files (optionally .gz) written by a merge run")
+    args = parser.parse_args()
+    for path in args.paths:
+        print(f"{path} -> {jsonl_to_json(path)}")
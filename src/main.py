@@ -1,17 +1,53 @@
-import requests
 import os
+import sys
 import csv
 import json
+import copy
+import math
+import argparse
+import tempfile
+import itertools
 import dotenv
 from datetime import datetime
 import logging
-from validate_csv import ValidateCSV
+from collections import deque
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from validate_csv import ValidateCSV, ValidationError
+from scheduler import KeyScheduler
+from journal import MergeJournal
+from association_cache import AssociationCache
+from output_writer import JsonlWriter
+from planner import plan_key_associations, count_plan_calls
+from clustering import MergeClusters
+from records import RecordStore
+from columnar import ColumnarInput, is_columnar_input, read_rows as read_columnar_rows
+from transport import HubspotTransport
+from rate_governor import RateGovernor
+from metrics import MergeMetrics
+from tracing import Tracer, profiled
+from paging import PrefetchingPages
+from grouped_input import key_sort_value, iter_contiguous_groups, partition_rows, iter_partition_groups, iter_windows, read_stream_rows, KeyQueue
+
+COMPANY_BATCH_READ_SIZE = 100
+ASSOCIATION_BATCH_SIZE = 1000
+ASSOCIATION_PAGE_SIZE = 500
+# Batches of one key's association changes sent at the same time
+ASSOCIATION_WRITE_WORKERS = 4
+KEY_WINDOW_SIZE = 500
 
 class HubspotAPI():
-    def __init__(self, base_path="", test=False, api_key=None, input_file_path="../input_data.csv"):
+    def __init__(self, base_path="", test=False, api_key=None, input_file_path="../input_data.csv", max_workers=1,
+                 base_url="https://api.hubapi.com", pool_size=None, connect_timeout=5, read_timeout=30, gzip=True,
+                 cache_ttl=3600, cache_size=100000, cache_path=None, association_cache=None, output_gzip=False,
+                 output_dir="./data", rate_limiter=None, metrics=None, progress_interval=10, tracer=None, transport=None, scheduler=None, governor=None):
         self.base_path = base_path
         self.input_data_file = input_file_path
         self.test = test
+        self.max_workers = max_workers
+        self.output_gzip = output_gzip
+        self.output_dir = output_dir
         if api_key:
             self.access_token = api_key
         else:
@@ -25,101 +61,365 @@ class HubspotAPI():
             "Authorization": f"Bearer {self.access_token}",
             "Content-Type": "application/json"
         }
+        # Call counts, latencies and progress of the run; see metrics.py
+        self.metrics = metrics or MergeMetrics(report_interval=progress_interval, prometheus_path=f"{output_dir}/metrics/hubspot_merge.prom")
+        # Paces every request and retries 429s and failed idempotent calls, so a
+        # burst of rate limiting does not leave a key half done; see rate_governor.py.
+        # Each worker can have ASSOCIATION_WRITE_WORKERS batches in flight.
+        self.governor = governor or (transport.governor if transport else None) or RateGovernor(max_in_flight=max(1, max_workers) * ASSOCIATION_WRITE_WORKERS)
+        # A transport passed in is shared with other clients (see service.py); its
+        # owner decides which listeners and governor it has
+        self.transport = transport or HubspotTransport(
+            self.access_token,
+            base_url=base_url,
+            pool_size=pool_size or max(10, max_workers * ASSOCIATION_WRITE_WORKERS),
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            gzip=gzip,
+            rate_limiter=rate_limiter,
+            listeners=[self.metrics.on_response],
+            governor=self.governor
+        )
+        # Spans of keys, phases and HTTP calls for a trace viewer; see tracing.py
+        self.tracer = tracer
+        if tracer:
+            self.transport.add_listener(tracer.on_response)
         self.associations_code_map = {
             "parent_to_child": 13,
             "child_to_parent": 14
         }
+        self.association_cache = association_cache or AssociationCache(ttl=cache_ttl, max_entries=cache_size, path=cache_path)
+        # A scheduler passed in shares its company locks with other clients' runs
+        self.shared_scheduler = scheduler
+        self.journal = None
+        self.processed_companies = set()
+        self.progress = None
+
+    def load_and_group_data(self, max_errors=100):
+        # The rows are kept in columns grouped by key (see records.py). Reading a key
+        # gives CompanyRecords, which index like the CSV row dicts with the action
+        # lowercased. Parquet, Arrow and compressed CSV files are read with pyarrow
+        # and stay in Arrow columns (see columnar.py).
+        if is_columnar_input(self.input_data_file):
+            grouped_data = ColumnarInput(self.input_data_file)
+        else:
+            with open(self.input_data_file, mode='r', encoding='utf-8') as file:
+                grouped_data = RecordStore.from_rows(csv.DictReader(file))
+        try:
+            ValidateCSV(grouped_data, max_errors=max_errors)
+        except ValueError as e:
+            self.validation_failed(e)
 
-    def load_and_group_data(self):
+        return grouped_data
+
+    def load_and_cluster_data(self, max_errors=100):
+        # Reads pairwise merge rows and groups chained or overlapping pairs into
+        # clusters, so every cluster is merged into its one survivor in a single key
+        validator = ValidateCSV(max_errors=max_errors, allow_chains=True)
+        clusters = MergeClusters()
+        for row_number, row in enumerate(self.read_input_rows(), start=2):
+            validator.add(row, row_number)
+            clusters.add_row(row)
+        try:
+            validator.finish()
+            grouped_data, errors = clusters.grouped_data()
+            if errors:
+                for error in errors:
+                    logging.error(error["message"])
+                raise ValidationError(errors[0]["message"], errors)
+        except ValueError as e:
+            self.validation_failed(e)
+
+        cluster_count = sum(1 for companies in grouped_data.values() if len(companies) > 2)
+        logging.info(f"Grouped {validator.row_count} rows into {len(grouped_data)} merge clusters ({cluster_count} with more than two companies)")
+        return grouped_data
+
+    def read_input_rows(self):
+        if is_columnar_input(self.input_data_file):
+            yield from read_columnar_rows(self.input_data_file)
+            return
         with open(self.input_data_file, mode='r', encoding='utf-8') as file:
-            csv_reader = csv.DictReader(file)
-            data = list(csv_reader)
-            for row in data:
+            for row in csv.DictReader(file):
                 row['action'] = row['action'].lower() # Lowercase the action column
+                yield row
+
+    def validation_failed(self, e):
+        # Every violation found goes to a report next to the other error outputs
+        if isinstance(e, ValidationError):
+            os.makedirs(f"{self.output_dir}/errors", exist_ok=True)
+            report_path = f"{self.output_dir}/errors/validation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+            self.write_to_json(e.errors, report_path)
+            logging.error(f"Validation report written to {report_path}")
+        error_message = f"Validation error: {e}"
+        logging.error(error_message)
+        raise Exception(error_message)
+
+    def iter_grouped_data(self, max_errors=100):
+        # Streams (key, rows) groups without holding the file in memory. The whole
+        # file is validated in one pass before the first key is returned. A file that
+        # is not sorted by key is hash-partitioned to disk first.
+        if is_columnar_input(self.input_data_file):
+            # Already memory-mapped and grouped by key in Arrow columns
+            return self.load_and_group_data(max_errors=max_errors)
+        with open(self.input_data_file, mode='r', encoding='utf-8') as file:
+            fieldnames = csv.DictReader(file).fieldnames
+        is_sorted = self.validate_input_rows(max_errors)
+        return self.stream_groups(is_sorted, fieldnames)
+
+    def validate_input_rows(self, max_errors=100):
+        # While the keys come in sorted order, each key is closed when the next one
+        # starts, so only the rows of the open key are held. If a key comes out of
+        # order, it may be one that was closed already, and the file is validated
+        # again holding every key until the end. Returns whether the file is sorted.
+        validator = ValidateCSV(max_errors=max_errors)
+        previous_key = previous = None
+        for row_number, row in enumerate(self.read_input_rows(), start=2):
+            if row["key"] != previous_key:
+                current = key_sort_value(row["key"])
+                if previous is not None and current <= previous:
+                    break
+                if previous_key is not None:
+                    validator.close_key(previous_key)
+                previous_key, previous = row["key"], current
+            validator.add(row, row_number)
+        else:
+            self.finish_validation(validator)
+            return True
+
+        validator = ValidateCSV(max_errors=max_errors)
+        for row_number, row in enumerate(self.read_input_rows(), start=2):
+            validator.add(row, row_number)
+        self.finish_validation(validator)
+        return False
+
+    def finish_validation(self, validator):
         try:
-            ValidateCSV(data)
+            validator.finish()
         except ValueError as e:
-            error_message = f"Validation error: {e}"
-            logging.error(error_message)
-            raise Exception(error_message)
-            
-        grouped_data = {}
-        for row in data:
-            key = row['key']
-            if key not in grouped_data:
-                grouped_data[key] = []
-            grouped_data[key].append(row)
+            self.validation_failed(e)
+
+    def stream_groups(self, is_sorted, fieldnames):
+        if is_sorted:
+            yield from iter_contiguous_groups(self.read_input_rows())
+            return
+        with tempfile.TemporaryDirectory(prefix="merge_partitions_") as partition_directory:
+            partition_paths = partition_rows(self.read_input_rows(), fieldnames, partition_directory)
+            yield from iter_partition_groups(partition_paths)
+
+    def read_stream_groups(self, stream, output_writer, input_format=None):
+        # Pipe mode: groups are read from the stream by a background thread as they
+        # arrive. A key is complete once the next key starts or the input ends, and
+        # is validated then, so a key with more than two rows is caught as a whole.
+        # A key that breaks a rule is written to the output with its errors and left
+        # out, and the rest carry on.
+        def validated(groups):
+            validator = ValidateCSV(max_errors=None)
+            row_number = 1
+            for key, rows in groups:
+                for row in rows:
+                    row_number += 1
+                    validator.add(row, row_number)
+                validator.close_key(key)
+                if validator.errors:
+                    output_writer.write({"key": key, "error": "Invalid input", "validation_errors": validator.errors})
+                    self.metrics.key_finished("invalid")
+                    validator.errors = []
+                    continue
+                yield key, rows
+
+        return KeyQueue(validated(iter_contiguous_groups(read_stream_rows(stream, input_format))))
 
-        return grouped_data
-    
     def write_to_json(self, data, output_path):
         with open(output_path, 'w', encoding='utf-8') as file:
             json.dump(data, file, indent=2)
 
         
-    def check_company_exists(self, company_id):
-        url = f"https://api.hubapi.com/crm/v3/objects/companies/{company_id}"
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 200 and company_id == response.json()["id"]:
-            return True
-        else:
-            error_message = f"Error fetching company with id {company_id}. Status code: {response.status_code}"
-            logging.error(error_message)
-            return False
-
-    def get_child_parent_companies(self, company_id, child_or_parent):
-        url = f"https://api.hubapi.com/crm-associations/v1/associations/{company_id}/HUBSPOT_DEFINED/{self.associations_code_map[child_or_parent]}"
-        response = requests.get(url, headers=self.headers)
-        if response.status_code != 200:
-            error_message = f"Error fetching {child_or_parent} companies: {response.status_code}"
-            logging.error(error_message)
-            raise Exception(error_message)
-        return response.json()
+    def check_companies_exist(self, company_ids):
+        # Returns the ids that exist as themselves, and the ids that now redirect to
+        # another company because they were merged earlier
+        existing = set()
+        redirected = {}
+        company_ids = list(dict.fromkeys(company_ids))
+        for start in range(0, len(company_ids), COMPANY_BATCH_READ_SIZE):
+            batch = company_ids[start:start + COMPANY_BATCH_READ_SIZE]
+            payload = {
+                "properties": ["hs_object_id", "hs_merged_object_ids"],
+                "inputs": [{"id": company_id} for company_id in batch]
+            }
+            response = self.transport.post("/crm/v3/objects/companies/batch/read", json=payload)
+            if response.status_code not in (200, 207):
+                error_message = f"Error fetching companies in batch: {response.status_code} - {response.text}"
+                logging.error(error_message)
+                raise Exception(error_message)
+
+            requested = set(batch)
+            for result in response.json().get("results", []):
+                result_id = result["id"]
+                if result_id in requested:
+                    existing.add(result_id)
+                merged_ids = (result.get("properties", {}).get("hs_merged_object_ids") or "").split(";")
+                for merged_id in merged_ids:
+                    if merged_id in requested and merged_id != result_id:
+                        redirected[merged_id] = result_id
+        return existing, redirected
+
+    def load_associations(self, company_ids):
+        # Parent and child companies of many companies at once, through the v4 batch
+        # associations API. Companies without associations get empty lists.
+        associations = {}
+        company_ids = list(dict.fromkeys(company_ids))
+        for start in range(0, len(company_ids), ASSOCIATION_BATCH_SIZE):
+            batch = company_ids[start:start + ASSOCIATION_BATCH_SIZE]
+            for company_id in batch:
+                associations[company_id] = {"child_companies": [], "parent_companies": []}
+
+            payload = {"inputs": [{"id": company_id} for company_id in batch]}
+            response = self.transport.post("/crm/v4/associations/companies/companies/batch/read", json=payload)
+            if response.status_code not in (200, 207):
+                error_message = f"Error fetching associations in batch: {response.status_code} - {response.text}"
+                logging.error(error_message)
+                raise Exception(error_message)
+
+            for result in response.json().get("results", []):
+                company_id = str(result["from"]["id"])
+                self.add_associations(associations[company_id], result.get("to", []))
+                after = result.get("paging", {}).get("next", {}).get("after")
+                if after:
+                    self.add_associations(associations[company_id], self.iter_company_associations(company_id, after))
+        return associations
+
+    def iter_company_associations(self, company_id, after=None):
+        # Companies with more associations than fit in a batch result are paged; the
+        # next page is fetched while the current one is read
+        def fetch_page(after):
+            response = self.transport.get(f"/crm/v4/objects/companies/{company_id}/associations/companies", params={"after": after, "limit": ASSOCIATION_PAGE_SIZE})
+            if response.status_code != 200:
+                error_message = f"Error fetching associations for company {company_id}: {response.status_code} - {response.text}"
+                logging.error(error_message)
+                raise Exception(error_message)
+            response_data = response.json()
+            return response_data.get("results", []), response_data.get("paging", {}).get("next", {}).get("after")
+        return PrefetchingPages(self.bind(fetch_page), cursor=after)
+
+    def add_associations(self, company_associations, associated):
+        for association in associated:
+            for association_type in association.get("associationTypes", []):
+                if association_type.get("category") != "HUBSPOT_DEFINED":
+                    continue
+                if association_type["typeId"] == self.associations_code_map["parent_to_child"]:
+                    company_associations["child_companies"].append(int(association["toObjectId"]))
+                elif association_type["typeId"] == self.associations_code_map["child_to_parent"]:
+                    company_associations["parent_companies"].append(int(association["toObjectId"]))
+
+    def cache_associations(self, company_ids):
+        associations = self.load_associations(company_ids)
+        for company_id, company_associations in associations.items():
+            self.association_cache.put(company_id, company_associations)
+        return associations
 
     def enrich_companies(self, current_key_data):
-        self.companies_with_child_parent = []
+        associations = {}
+        for company in current_key_data:
+            cached = self.association_cache.get(company["id"])
+            if cached is not None:
+                associations[company["id"]] = cached
+        missing_ids = [company["id"] for company in current_key_data if company["id"] not in associations]
+        if missing_ids:
+            associations.update(self.cache_associations(missing_ids))
+
+        companies_with_child_parent = []
         for company in current_key_data:
             company_id = company["id"]
+            company_associations = associations[company_id]
             company_enriched = {
                 "id": company_id,
                 "company_name": company["company_name"],
                 "key": company["key"],
                 "action": company["action"],
-                "child_companies": self.get_child_parent_companies(company_id, "parent_to_child").get("results", []),
-                "parent_companies": self.get_child_parent_companies(company_id, "child_to_parent").get("results", [])
+                "child_companies": list(company_associations["child_companies"]),
+                "parent_companies": list(company_associations["parent_companies"])
             }
-            self.companies_with_child_parent.append(company_enriched)
-        return self.companies_with_child_parent
+            companies_with_child_parent.append(company_enriched)
+        return companies_with_child_parent
 
-    def remove_association(self, from_id, to_id, definition_id):
-        url = "https://api.hubapi.com/crm-associations/v1/associations/delete"
+    def get_related_company_ids(self, companies_with_child_parent):
+        related_ids = set()
+        for company in companies_with_child_parent:
+            related_ids.update(str(company_id) for company_id in company["child_companies"])
+            related_ids.update(str(company_id) for company_id in company["parent_companies"])
+        return related_ids
+
+    def write_associations(self, path, edges):
+        # Edges are (child_id, parent_id) pairs, from a list or any iterator, written
+        # as child_to_parent associations in batches. Up to ASSOCIATION_WRITE_WORKERS
+        # batches are sent at once and only those are held, so a long stream of
+        # edges is written as it is read. Returns one error per edge that failed.
+        edges = iter(edges)
+        batches = iter(lambda: list(itertools.islice(edges, ASSOCIATION_BATCH_SIZE)), [])
+        first_batches = list(itertools.islice(batches, 2))
+        if len(first_batches) < 2:
+            return [error for batch in first_batches for error in self.write_association_batch(path, batch)]
+
+        errors = []
+        write_batch = self.bind(self.write_association_batch)
+        with ThreadPoolExecutor(max_workers=ASSOCIATION_WRITE_WORKERS) as executor:
+            pending = deque(executor.submit(write_batch, path, batch) for batch in first_batches)
+            for batch in batches:
+                if len(pending) >= ASSOCIATION_WRITE_WORKERS:
+                    errors += pending.popleft().result()
+                pending.append(executor.submit(write_batch, path, batch))
+            while pending:
+                errors += pending.popleft().result()
+        return errors
+
+    def write_association_batch(self, path, batch):
         payload = {
-            "fromObjectId": from_id,
-            "toObjectId": to_id,
-            "category": "HUBSPOT_DEFINED",
-            "definitionId": definition_id
+            "inputs": [{
+                "from": {"id": str(child_id)},
+                "to": {"id": str(parent_id)},
+                "types": [{"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": self.associations_code_map["child_to_parent"]}]
+            } for child_id, parent_id in batch]
         }
-        response = requests.put(url, headers=self.headers, json=payload)
-        if response.status_code != 204:
-            error_message = f"Error removing association: {response.status_code} - {response.text}"
+        response = self.transport.post(path, json=payload)
+        if response.status_code in (200, 201, 204):
+            return []
+        errors = []
+        if response.status_code == 207:
+            for error in response.json().get("errors", []):
+                context_ids = {str(value) for values in error.get("context", {}).values() for value in values}
+                failed_edges = [edge for edge in batch if str(edge[0]) in context_ids and str(edge[1]) in context_ids] or batch
+                for child_id, parent_id in failed_edges:
+                    errors.append({"child_id": child_id, "parent_id": parent_id, "error": error.get("message", "")})
+        else:
+            for child_id, parent_id in batch:
+                errors.append({"child_id": child_id, "parent_id": parent_id, "error": f"{response.status_code} - {response.text}"})
+        return errors
+
+    def remove_associations(self, edges):
+        return self.write_associations("/crm/v4/associations/companies/companies/batch/labels/archive", edges)
+
+    def create_associations(self, edges):
+        return self.write_associations("/crm/v4/associations/companies/companies/batch/create", edges)
+
+    def successful_edges(self, edges, errors):
+        failed_edges = {(str(error["child_id"]), str(error["parent_id"])) for error in errors}
+        return [edge for edge in edges if (str(edge[0]), str(edge[1])) not in failed_edges]
+
+    def remove_child_parent_associations(self, plan):
+        edges = plan["detach"]
+        for child_id, parent_id in edges:
+            logging.info(f"Removing association between child {child_id} and parent {parent_id}")
+
+        errors = self.remove_associations(edges)
+        self.association_cache.apply_detach(self.successful_edges(edges, errors))
+        if errors:
+            error_message = f"Error removing {len(errors)} associations: {errors}"
             logging.error(error_message)
             raise Exception(error_message)
 
-    def remove_child_parent_associations(self, companies_with_child_parent):
-        for company in companies_with_child_parent:
-            company_id = company["id"]
-            for child_id in company["child_companies"]:
-                logging.info(f"Removing association between child {child_id} and parent {company_id}")
-                self.remove_association(child_id, company_id, self.associations_code_map["child_to_parent"])
-            
-            for parent_id in company["parent_companies"]:
-                logging.info(f"Removing association between parent {company_id} and child {parent_id}")
-                self.remove_association(company_id, parent_id, self.associations_code_map["child_to_parent"])
-
-    def merge_companies(self, companies):
-        self.merged_companies = []
-        self.merge_results = []
-    
+    def merge_companies(self, companies, plan):
+        merged_companies = []
+
         # Identify the target company
         for company in companies:
             if company["action"] == "keep":
@@ -130,129 +430,301 @@ class HubspotAPI():
         # Process and merge companies
         for company in companies:
             if company["action"] != "keep":
-                logging.info(f"Attempting to merge {company['id']} into {target_company['id']}")
-                self.merge_company(company["id"], target_company["id"])
-                target_company["child_companies"].extend(company.get("child_companies", []))
-                if "parent_companies" in company and company["parent_companies"] and not original_parent:
-                    target_company["parent_companies"] = company["parent_companies"]
-                if original_parent:
-                    target_company["parent_companies"] = original_parent
-
+                if company["id"] in self.processed_companies:
+                    logging.info(f"Company {company['id']} was already merged into {target_company['id']}")
+                else:
+                    logging.info(f"Attempting to merge {company['id']} into {target_company['id']}")
+                    self.merge_company(company["id"], target_company["id"])
+                    self.processed_companies.add(company["id"])
+                    if self.journal:
+                        self.journal.record_merge(company["key"], company["id"], target_company["id"])
+
+        # Associations of the kept company once the plan has been applied
+        target_company["child_companies"] = plan["child_companies"]
+        target_company["parent_companies"] = plan["parent_companies"]
         target_company["original_parent"] = original_parent
-        self.merged_companies.append(target_company)
-        return self.merged_companies
+        merged_companies.append(target_company)
+        return merged_companies
 
     def merge_company(self, source_company_id, target_company_id):
-        url = "https://api.hubapi.com/crm/v3/objects/companies/merge"
         payload = {
             "primaryObjectId": target_company_id,
             "objectIdToMerge": source_company_id
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+        response = self.transport.post("/crm/v3/objects/companies/merge", json=payload)
         if response.status_code != 200:
             error_message = f"Error merging company {source_company_id} into {target_company_id}: {response.status_code} - {response.text}"
             logging.error(error_message)
             raise Exception(error_message)
         else:
             logging.info(f"Merged company {source_company_id} into {target_company_id}")
-            self.merge_results.append({
+            self.association_cache.apply_merge(source_company_id, target_company_id)
+            return {
                 "merged_company_id": source_company_id,
                 "into_company_id": target_company_id
-            })
-
-    def reassociate_companies(self, merged_companies):
-        for company in merged_companies:
-            company_id = company.get("id")
-            if not company_id or company.get("action") == "merge":
-                continue
-
-            logging.info(f"Reassociating for company ID: {company_id}")
-            for child_id in company.get("child_companies", []):
-                logging.info(f"Creating child association: {company_id} -> {child_id}")
-                self.create_association(child_id, company_id, self.associations_code_map["child_to_parent"])
+            }
 
-            if company.get("parent_companies") or company.get("original_parent"):
-                logging.info(f"Creating parent association: {company.get('parent_companies')} -> {company_id}")
-                self.create_association(company_id, self.get_parent_value(company), self.associations_code_map["child_to_parent"])
+    def reassociate_companies(self, plan):
+        edges = plan["attach"]
+        for child_id, parent_id in edges:
+            logging.info(f"Creating association between child {child_id} and parent {parent_id}")
 
-    def create_association(self, from_id, to_id, definition_id):
-        url = "https://api.hubapi.com/crm-associations/v1/associations"
-        payload = {
-            "fromObjectId": from_id,
-            "toObjectId": to_id,
-            "category": "HUBSPOT_DEFINED",
-            "definitionId": definition_id
-        }
-        response = requests.put(url, headers=self.headers, json=payload)
-        if response.status_code != 204:
-            error_message = f"Error creating association: {response.status_code} - {response.text}"
+        errors = self.create_associations(edges)
+        self.association_cache.apply_attach(self.successful_edges(edges, errors))
+        if errors:
+            error_message = f"Error creating {len(errors)} associations: {errors}"
             logging.error(error_message)
             raise Exception(error_message)
-        else:
-            logging.info(f"Association created between {from_id} and {to_id}")
-
-    def get_parent_value(self, data):
-        # Check if 'original_parent' key exists and its list is not empty
-        if 'original_parent' in data and data['original_parent']:
-            return data['original_parent'][0]
-        # Fallback to 'parent_companies' if 'original_parent' is not available or is empty
-        elif 'parent_companies' in data and data['parent_companies']:
-            return data['parent_companies'][0]
-        else:
-            return None 
-        
-    def run_merge(self, grouped_data):
-        self.intermediate = []
-        self.results = []
-        self.missing = []
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        processed_companies = set()
-
-        for key, companies in grouped_data.items():
-            logging.info(f"Processing key: {key}")
-
-            # Check that companies exist and have not been processed
-            company_missing = False
+        logging.info(f"Created {len(edges)} associations")
+
+    def process_key(self, key, companies, key_state=None):
+        # key_state holds the phases a previous run already recorded for this key
+        key_state = key_state or {}
+        logging.info(f"Processing key: {key}" + (f" (resuming after {list(key_state)[-1]})" if key_state else ""))
+        with self.span("wait for locks", "lock"):
+            self.scheduler.acquire(company["id"] for company in companies)
+        try:
+            # Companies merged away by an earlier key
             for company in companies:
-                if company["id"] in processed_companies or not self.check_company_exists(company["id"]):
-                    company_missing = True
+                if not key_state and company["id"] in self.processed_companies:
                     missing_dict = {
                         "key": key,
                         "company_id": company["id"],
                         "error": "Company not found"
                     }
-                    self.missing.append(missing_dict)
+                    logging.info(f"Skipping key {key}: One or more companies not found or already merged.")
+                    return missing_dict, None, None
+
+            # Lock the parents and children as well before touching any association. If
+            # another key holds one of them, start over holding everything at once.
+            while True:
+                if "enriched" in key_state:
+                    companies_with_child_parent = key_state["enriched"]
+                else:
+                    with self.phase("enrich"):
+                        companies_with_child_parent = self.enrich_companies(companies)
+                related_ids = self.get_related_company_ids(companies_with_child_parent)
+                if self.scheduler.try_acquire(related_ids):
+                    break
+                self.scheduler.release()
+                with self.span("wait for locks", "lock"):
+                    self.scheduler.acquire(related_ids | {company["id"] for company in companies})
+            if "enriched" not in key_state:
+                self.record_phase(key, "enriched", companies_with_child_parent)
+            plan = plan_key_associations(companies_with_child_parent)
+
+            if "detached" not in key_state:
+                with self.phase("detach"):
+                    self.remove_child_parent_associations(plan)
+                self.record_phase(key, "detached")
+
+            if "merged" in key_state:
+                merged_companies = key_state["merged"]
+            else:
+                with self.phase("merge"):
+                    merged_companies = self.merge_companies(copy.deepcopy(companies_with_child_parent), plan)
+                self.record_phase(key, "merged", merged_companies)
+
+            with self.phase("reattach"):
+                self.reassociate_companies(plan)
+            self.record_phase(key, "reattached")
+            return None, companies_with_child_parent, merged_companies
+        except Exception:
+            # The associations of these companies may be half changed, so they are
+            # loaded again the next time they are needed
+            for company_id in self.scheduler.held_ids():
+                self.association_cache.remove(company_id)
+            self.metrics.key_finished("failed")
+            raise
+        finally:
+            self.scheduler.release()
+
+    @contextmanager
+    def phase(self, name):
+        with self.metrics.phase(name), self.span(name):
+            yield
+
+    def span(self, name, category="phase", **args):
+        return self.tracer.span(name, category, **args) if self.tracer else nullcontext()
+
+    def bind(self, function):
+        # Work handed to another thread keeps the metrics phase and the trace spans
+        # of the thread that hands it over
+        function = self.metrics.bind(function)
+        return self.tracer.bind(function) if self.tracer else function
+
+    def record_phase(self, key, phase, data=None):
+        if self.journal:
+            self.journal.record(key, phase, data)
+
+    def run_window(self, window):
+        key_outputs = {}
+        key_states = self.journal.load_keys(key for key, companies in window) if self.journal else {}
+        for key, companies in window:
+            key_state = key_states.get(str(key), {})
+            if "reattached" in key_state:
+                logging.info(f"Skipping key {key}: already completed in a previous run")
+                key_outputs[key] = (None, key_state["enriched"], key_state["merged"])
+                self.write_key_output(key, key_outputs[key])
+
+        # Check that all companies of the window exist before any of its keys start.
+        # Keys a previous run already started are past this check.
+        new_keys = [(key, companies) for key, companies in window if str(key) not in key_states]
+        with self.phase("existence"):
+            existing, redirected = self.check_companies_exist(company["id"] for key, companies in new_keys for company in companies)
+        for key, companies in new_keys:
+            for company in companies:
+                if company["id"] not in existing:
+                    error = f"Company already merged into {redirected[company['id']]}" if company["id"] in redirected else "Company not found"
+                    logging.error(f"Error fetching company with id {company['id']}: {error}")
+                    logging.info(f"Skipping key {key}: One or more companies not found or already merged.")
+                    key_outputs[key] = ({"key": key, "company_id": company["id"], "error": error}, None, None)
+                    self.write_key_output(key, key_outputs[key])
                     break
 
-            if company_missing:
-                logging.info(f"Skipping key {key}: One or more companies not found or already merged.")
-                continue
-
-            companies_with_child_parent = self.enrich_companies(companies)
-
-            self.remove_child_parent_associations(companies_with_child_parent)
-            merged_companies = self.merge_companies(companies_with_child_parent)
-            self.reassociate_companies(merged_companies)
-
-            # Outputs
-            self.intermediate.append(companies_with_child_parent)
-            self.results.append(merged_companies)
-
-        if self.missing:
-            self.write_to_json(self.missing, f"./data/errors/missing_{timestamp}.json")
-        self.write_to_json(self.intermediate, f"./data/intermediate/pre_merge_{timestamp}.json")
-        self.write_to_json(self.results, f"./data/outputs/merged_{timestamp}.json")
+        # Associations of every company that will be merged and is not cached yet, in
+        # a few batch calls. The companies are locked while they are read and cached:
+        # with a shared cache and scheduler (see service.py) a key of another run could
+        # otherwise change one after the read and have its update overwritten. Companies
+        # another key holds are left out and read when their own key starts.
+        with self.phase("enrich"):
+            uncached_ids = [company["id"] for key, companies in new_keys if key not in key_outputs for company in companies if not self.association_cache.contains(company["id"])]
+            locked_ids = self.scheduler.acquire_free(uncached_ids)
+            try:
+                self.cache_associations([company_id for company_id in uncached_ids if company_id in locked_ids])
+            finally:
+                self.scheduler.release()
+
+        def run_key(key, companies):
+            with self.span(f"key {key}", "key", key=str(key)):
+                key_outputs[key] = self.process_key(key, companies, key_states.get(str(key)))
+            self.write_key_output(key, key_outputs[key])
+
+        self.scheduler.run(((key, companies) for key, companies in window if key not in key_outputs), run_key)
+        return key_outputs
+
+    def write_key_output(self, key, key_output):
+        # Each key's outputs are appended as soon as the key finishes
+        missing_dict, companies_with_child_parent, merged_companies = key_output
+        if missing_dict:
+            self.missing_writer.write(missing_dict)
+        else:
+            if self.intermediate_writer:
+                self.intermediate_writer.write({"key": key, "companies": companies_with_child_parent})
+            self.results_writer.write({"key": key, "companies": merged_companies})
+        self.metrics.key_finished("missing" if missing_dict else "merged")
+        if self.progress:
+            self.progress(key, "missing" if missing_dict else "merged")
+
+    def plan_merge(self, grouped_data, window_size=KEY_WINDOW_SIZE):
+        # Dry run: reads companies and associations and writes the changes each key
+        # would make, without changing anything. Each key is planned against the
+        # current associations, so keys that touch the same companies may differ
+        # from a real run.
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        plan_writer = JsonlWriter(f"{self.output_dir}/outputs/plan_{timestamp}.jsonl")
+        totals = {"keys": 0, "skipped": 0, "read_calls": 0, "detach": 0, "merge": 0, "attach": 0, "total": 0}
+        items = grouped_data.items() if isinstance(grouped_data, Mapping) else grouped_data
+        try:
+            for window in iter_windows(items, window_size):
+                company_ids = [company["id"] for key, companies in window for company in companies]
+                existing, redirected = self.check_companies_exist(company_ids)
+                uncached_ids = [company_id for company_id in company_ids if company_id in existing and not self.association_cache.contains(company_id)]
+                self.cache_associations(uncached_ids)
+                totals["read_calls"] += math.ceil(len(set(company_ids)) / COMPANY_BATCH_READ_SIZE) + math.ceil(len(set(uncached_ids)) / ASSOCIATION_BATCH_SIZE)
+
+                for key, companies in window:
+                    missing_ids = [company["id"] for company in companies if company["id"] not in existing]
+                    if missing_ids:
+                        totals["skipped"] += 1
+                        plan_writer.write({"key": key, "skipped": True, "missing_company_ids": missing_ids})
+                        continue
+                    plan = plan_key_associations(self.enrich_companies(companies))
+                    calls = count_plan_calls(plan, ASSOCIATION_BATCH_SIZE)
+                    logging.info(f"Key {key}: detach {len(plan['detach'])} edges, {len(plan['merges'])} merges, create {len(plan['attach'])} edges ({calls['total']} calls)")
+                    plan_writer.write({"key": key, "detach": plan["detach"], "merges": plan["merges"], "attach": plan["attach"], "calls": calls})
+                    totals["keys"] += 1
+                    for phase in ("detach", "merge", "attach", "total"):
+                        totals[phase] += calls[phase]
+        finally:
+            plan_writer.close()
+
+        totals["total"] += totals["read_calls"]
+        calls_per_key = totals["total"] / totals["keys"] if totals["keys"] else 0
+        logging.info(f"Dry run: {totals['keys']} keys to merge, {totals['skipped']} skipped, {totals['total']} calls ({calls_per_key:.2f} per key). Plan written to {plan_writer.path}")
+        return totals
+
+    def run_merge(self, grouped_data, window_size=KEY_WINDOW_SIZE, journal=None, collect_results=True, progress=None, output_writer=None):
+        # progress, if given, is called with (key, "merged" or "missing") as each key finishes
+        self.results = []
+        self.missing = []
+        self.progress = progress
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        if output_writer is None:
+            self.missing_writer = JsonlWriter(f"{self.output_dir}/errors/missing_{timestamp}.jsonl", gzip_output=self.output_gzip)
+            self.intermediate_writer = JsonlWriter(f"{self.output_dir}/intermediate/pre_merge_{timestamp}.jsonl", gzip_output=self.output_gzip)
+            self.results_writer = JsonlWriter(f"{self.output_dir}/outputs/merged_{timestamp}.jsonl", gzip_output=self.output_gzip)
+        else:
+            # One writer for every key: its merged companies, or why it was skipped
+            self.missing_writer = self.results_writer = output_writer
+            self.intermediate_writer = None
+        self.journal = journal
+        self.processed_companies = journal.merged_company_ids() if journal else set()
+        self.scheduler = self.shared_scheduler or KeyScheduler(self.max_workers)
+
+        # grouped_data is either the RecordStore from load_and_group_data (or another
+        # mapping of key to rows), a stream of
+        # (key, rows) from iter_grouped_data, or a KeyQueue from read_stream_groups.
+        # Keys are processed in windows, so a stream never has to be read ahead by
+        # more than one window; a KeyQueue's windows hold the keys that have arrived.
+        if isinstance(grouped_data, KeyQueue):
+            windows = grouped_data.windows(window_size)
+        else:
+            windows = iter_windows(grouped_data.items() if isinstance(grouped_data, Mapping) else grouped_data, window_size)
+        self.metrics.start(total_keys=len(grouped_data) if isinstance(grouped_data, Mapping) else None)
+        try:
+            for window in windows:
+                with self.span("window", "window", keys=len(window)):
+                    key_outputs = self.run_window(window)
+
+                # Returned results, in input order. The files above already have them.
+                for key, companies in window:
+                    if key not in key_outputs:
+                        continue
+                    missing_dict, companies_with_child_parent, merged_companies = key_outputs[key]
+                    if missing_dict:
+                        self.missing.append(missing_dict)
+                    elif collect_results:
+                        self.results.append(merged_companies)
+        finally:
+            for writer in dict.fromkeys(writer for writer in (self.missing_writer, self.intermediate_writer, self.results_writer) if writer):
+                writer.close()
+                if writer.count:
+                    logging.info(f"Wrote {writer.count} records to {writer.path}")
+            self.metrics.stop()
+            logging.info(self.metrics.progress_line())
+            self.metrics.write_summary(f"{self.output_dir}/metrics/metrics_{timestamp}.json")
+            if self.metrics.prometheus_path:
+                self.metrics.write_prometheus(self.metrics.prometheus_path)
+            if self.tracer:
+                self.tracer.write(f"{self.output_dir}/traces/trace_{timestamp}.json")
+
+        logging.info(f"Association cache: {self.association_cache.summary()}")
+        logging.info(f"Rate governor: {self.governor.stats()}")
         return self.results
 
 
 
-def run_hubspot_merge(test=False):
+def run_hubspot_merge(test=False, max_workers=1, stream=False, resume=False, cache_path=None, output_gzip=False, dry_run=False, clusters=False, progress_interval=10, trace=False, profile=False, input_file="input_data.csv"):
     # Create directories
     os.makedirs('logs', exist_ok=True)
     os.makedirs('data', exist_ok=True)
     os.makedirs('data/intermediate', exist_ok=True)
     os.makedirs('data/outputs', exist_ok=True)
     os.makedirs('data/errors', exist_ok=True)
+    os.makedirs('data/journal', exist_ok=True)
+    os.makedirs('data/metrics', exist_ok=True)
+    os.makedirs('data/traces', exist_ok=True)
     
     # Logging
     logging.basicConfig(filename='./logs/merge_operations.log',
@@ -279,8 +751,17 @@ def run_hubspot_merge(test=False):
                 return
         
         # Start client, load & validate data
-        hubspot_client = HubspotAPI(test=test, api_key=api_key, input_file_path="input_data.csv")
-        grouped_data = hubspot_client.load_and_group_data()
+        hubspot_client = HubspotAPI(test=test, api_key=api_key, input_file_path=input_file, max_workers=max_workers, cache_path=cache_path, output_gzip=output_gzip, progress_interval=progress_interval,
+                                    tracer=Tracer() if trace else None)
+        if clusters:
+            grouped_data = hubspot_client.load_and_cluster_data()
+        elif stream:
+            grouped_data = hubspot_client.iter_grouped_data()
+        else:
+            grouped_data = hubspot_client.load_and_group_data()
+
+        if dry_run:
+            return hubspot_client.plan_merge(grouped_data)
 
         # User confirmation
         if not test:
@@ -291,26 +772,74 @@ def run_hubspot_merge(test=False):
         
         # Run merge
         logging.info('Merge operation started')
-        merge_results = hubspot_client.run_merge(grouped_data)
+        journal = MergeJournal(f"./data/journal/{os.path.splitext(os.path.basename(hubspot_client.input_data_file))[0]}.sqlite", resume=resume)
+        try:
+            with profiled(f"./data/traces/profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof") if profile else nullcontext():
+                merge_results = hubspot_client.run_merge(grouped_data, journal=journal)
+        finally:
+            journal.close()
         return merge_results
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
 
+def read_access_token(token_file=None):
+    # For the modes without prompts: the token comes from a file or the environment
+    if token_file:
+        with open(token_file, mode='r', encoding='utf-8') as file:
+            access_token = file.read().strip()
+    else:
+        access_token = os.getenv("HUBSPOT_ACCESS_TOKEN")
+    if not access_token:
+        error_message = "No access token: set HUBSPOT_ACCESS_TOKEN or pass --token-file"
+        logging.error(error_message)
+        raise Exception(error_message)
+    return access_token
+
+
+def run_pipe_merge(token_file=None, input_format=None, max_workers=1, progress_interval=10):
+    # Headless mode for pipelines: no prompts, rows on stdin as they arrive, one JSON
+    # line per key on stdout, logs on stderr
+    logging.basicConfig(stream=sys.stderr,
+                        level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    access_token = read_access_token(token_file)
+
+    hubspot_client = HubspotAPI(api_key=access_token, max_workers=max_workers, progress_interval=progress_interval)
+    output_writer = JsonlWriter("<stdout>", flush_interval=0, stream=sys.stdout)
+    grouped_data = hubspot_client.read_stream_groups(sys.stdin, output_writer, input_format)
+    hubspot_client.run_merge(grouped_data, collect_results=False, output_writer=output_writer)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge pairs of Hubspot companies")
+    parser.add_argument("--input", default="input_data.csv", help="Input file: CSV, or Parquet, Arrow or .csv.gz with pyarrow installed")
+    parser.add_argument("--workers", type=int, default=1, help="Number of keys to process concurrently")
+    parser.add_argument("--stream", action="store_true", help="Read the input file one key at a time instead of loading it into memory")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run, skipping keys it already completed")
+    parser.add_argument("--association-cache", help="SQLite file that keeps loaded associations between runs")
+    parser.add_argument("--gzip-output", action="store_true", help="Gzip the JSON Lines output files")
+    parser.add_argument("--dry-run", action="store_true", help="Write the association changes and calls each key needs, without changing anything")
+    parser.add_argument("--clusters", action="store_true", help="Group chained and overlapping pairs into clusters merged into a single company")
+    parser.add_argument("--progress-interval", type=float, default=10, help="Seconds between progress lines (0 turns them off)")
+    parser.add_argument("--trace", action="store_true", help="Write a Chrome trace of every key, phase and HTTP call to data/traces")
+    parser.add_argument("--profile", action="store_true", help="Run the merge under cProfile and write the stats to data/traces")
+    parser.add_argument("--pipe", action="store_true", help="Read rows from stdin and write each key's result to stdout, without prompts")
+    parser.add_argument("--token-file", help="With --pipe, file holding the access token (default: HUBSPOT_ACCESS_TOKEN)")
+    parser.add_argument("--input-format", choices=["csv", "jsonl"], help="With --pipe, format of stdin (default: detected)")
+    args = parser.parse_args()
+
+    if args.pipe:
+        try:
+            run_pipe_merge(token_file=args.token_file, input_format=args.input_format, max_workers=args.workers, progress_interval=args.progress_interval)
+        except Exception as e:
+            logging.error(f"An error occurred: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
     # Run program
-    run_hubspot_merge()
+    run_hubspot_merge(max_workers=args.workers, stream=args.stream, resume=args.resume, cache_path=args.association_cache, output_gzip=args.gzip_output, dry_run=args.dry_run, clusters=args.clusters, progress_interval=args.progress_interval, trace=args.trace, profile=args.profile, input_file=args.input)
 
     # Finish
     logging.info('Merge operation finished')
-
-
-
-def csv_to_dict(csv_file_path):
-    data = []
-    with open(csv_file_path, mode="r", encoding="utf-8") as file:
-        csv_reader = csv.DictReader(file)
-        for row in csv_reader:
-            data.append(row)
-    return data
-
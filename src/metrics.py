@@ -0,0 +1,238 @@
+import os
+import re
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The phase each thread is in and the MergeMetrics of the run it belongs to. It is
+# shared by all MergeMetrics, so metrics that several runs report to (see
+# service.py) count a call against the phase of the run that made it.
+thread_phase = threading.local()
+
+
+def phase_metrics():
+    # The MergeMetrics whose phase the calling thread is in, if any
+    current = getattr(thread_phase, "current", None)
+    return current[0] if current else None
+
+
+def endpoint_name(method, path):
+    # Company ids are replaced so that calls to the same endpoint add up
+    return f"{method} {re.sub(r'/[0-9]+', '/{id}', path.split('?')[0])}"
+
+
+class MergeMetrics():
+    # Counts and timings of a merge run. The transport calls on_response() after
+    # every HTTP request; the call is counted against the phase the calling thread
+    # is in (see phase()). While the run is going, a progress line with keys/sec and
+    # ETA is logged every report_interval seconds, and the Prometheus textfile, if
+    # any, is rewritten so long runs can be watched on a dashboard.
+    def __init__(self, report_interval=10, prometheus_path=None):
+        self.report_interval = report_interval
+        self.prometheus_path = prometheus_path
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.phases = {}
+        self.keys = {"merged": 0, "missing": 0, "failed": 0}
+        self.total_keys = None
+        self.started_at = None
+        self.finished_at = None
+        self.stopped = threading.Event()
+        self.reporter = None
+
+    def start(self, total_keys=None):
+        self.total_keys = total_keys
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stopped.clear()
+        if self.report_interval:
+            self.reporter = threading.Thread(target=self.report, daemon=True)
+            self.reporter.start()
+
+    def stop(self):
+        self.finished_at = time.time()
+        self.stopped.set()
+        if self.reporter:
+            self.reporter.join()
+            self.reporter = None
+
+    def report(self):
+        while not self.stopped.wait(self.report_interval):
+            logging.info(self.progress_line())
+            if self.prometheus_path:
+                self.write_prometheus(self.prometheus_path)
+
+    @contextmanager
+    def phase(self, name):
+        previous = getattr(thread_phase, "current", None)
+        thread_phase.current = (self, name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            thread_phase.current = previous
+            with self.lock:
+                phase = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+                phase["count"] += 1
+                phase["seconds"] += elapsed
+
+    def bind(self, function):
+        # For work handed to another thread (prefetched pages, parallel batches): its
+        # calls are counted against the phase of the thread that handed it over
+        current = getattr(thread_phase, "current", None)
+
+        def bound(*args, **kwargs):
+            previous = getattr(thread_phase, "current", None)
+            thread_phase.current = current
+            try:
+                return function(*args, **kwargs)
+            finally:
+                thread_phase.current = previous
+        return bound
+
+    def on_response(self, method, path, status_code, seconds, attempt=1):
+        # status_code is None when no response was received
+        endpoint = endpoint_name(method, path)
+        current = getattr(thread_phase, "current", None)
+        phase = current[1] if current else "other"
+        with self.lock:
+            request = self.requests.get((endpoint, phase))
+            if request is None:
+                request = self.requests[(endpoint, phase)] = {
+                    "count": 0, "seconds": 0.0, "retries": 0, "status_codes": {}, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)
+                }
+            request["count"] += 1
+            request["seconds"] += seconds
+            if attempt > 1:
+                request["retries"] += 1
+            status = str(status_code) if status_code is not None else "error"
+            request["status_codes"][status] = request["status_codes"].get(status, 0) + 1
+            request["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def key_finished(self, status):
+        with self.lock:
+            self.keys[status] = self.keys.get(status, 0) + 1
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def progress_line(self):
+        with self.lock:
+            done = sum(self.keys.values())
+            keys = dict(self.keys)
+        elapsed = self.elapsed()
+        keys_per_second = done / elapsed if elapsed else 0.0
+        line = f"Progress: {done}"
+        if self.total_keys:
+            line += f"/{self.total_keys} keys ({done / self.total_keys:.1%})"
+        else:
+            line += " keys"
+        line += f", {keys['merged']} merged, {keys['missing']} missing, {keys['failed']} failed, {keys_per_second:.1f} keys/sec"
+        if self.total_keys and keys_per_second:
+            remaining = max(0, self.total_keys - done) / keys_per_second
+            line += f", ETA {int(remaining // 3600):02d}:{int(remaining % 3600 // 60):02d}:{int(remaining % 60):02d}"
+        return line
+
+    def summary(self):
+        with self.lock:
+            requests = [
+                {
+                    "endpoint": endpoint,
+                    "phase": phase,
+                    "count": request["count"],
+                    "retries": request["retries"],
+                    "status_codes": dict(request["status_codes"]),
+                    "seconds": round(request["seconds"], 3),
+                    "mean_seconds": round(request["seconds"] / request["count"], 4),
+                    "latency_buckets": {str(bound): count for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), request["buckets"])}
+                }
+                for (endpoint, phase), request in sorted(self.requests.items())
+            ]
+            phases = {name: {"count": phase["count"], "seconds": round(phase["seconds"], 3)} for name, phase in self.phases.items()}
+            keys = dict(self.keys)
+        elapsed = self.elapsed()
+        done = sum(keys.values())
+        total_requests = sum(request["count"] for request in requests)
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "keys": keys,
+            "total_keys": self.total_keys,
+            "keys_per_second": round(done / elapsed, 2) if elapsed else 0.0,
+            "requests": total_requests,
+            "requests_per_key": round(total_requests / done, 3) if done else 0.0,
+            "phases": phases,
+            "endpoints": requests
+        }
+
+    def write_summary(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def write_prometheus(self, path):
+        # Prometheus textfile collector format. The file is replaced in one step so
+        # the collector never reads half of it.
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary_path, path)
+
+    def prometheus_text(self):
+        summary = self.summary()
+        lines = [
+            "# HELP hubspot_merge_keys_total Keys finished, by outcome.",
+            "# TYPE hubspot_merge_keys_total counter"
+        ]
+        lines += [f'hubspot_merge_keys_total{{status="{status}"}} {count}' for status, count in summary["keys"].items()]
+        lines += [
+            "# HELP hubspot_merge_keys_per_second Keys finished per second since the run started.",
+            "# TYPE hubspot_merge_keys_per_second gauge",
+            f"hubspot_merge_keys_per_second {summary['keys_per_second']}"
+        ]
+        if summary["total_keys"]:
+            lines += [
+                "# HELP hubspot_merge_keys_expected Keys in the input.",
+                "# TYPE hubspot_merge_keys_expected gauge",
+                f"hubspot_merge_keys_expected {summary['total_keys']}"
+            ]
+        lines += [
+            "# HELP hubspot_merge_phase_seconds_total Time spent in each phase, summed over keys.",
+            "# TYPE hubspot_merge_phase_seconds_total counter"
+        ]
+        lines += [f'hubspot_merge_phase_seconds_total{{phase="{name}"}} {phase["seconds"]}' for name, phase in summary["phases"].items()]
+        lines += [
+            "# HELP hubspot_merge_requests_total HTTP requests, by endpoint, phase and status code.",
+            "# TYPE hubspot_merge_requests_total counter"
+        ]
+        for request in summary["endpoints"]:
+            for status, count in request["status_codes"].items():
+                lines.append(f'hubspot_merge_requests_total{{endpoint="{request["endpoint"]}",phase="{request["phase"]}",status="{status}"}} {count}')
+        lines += [
+            "# HELP hubspot_merge_retries_total Retried HTTP requests, by endpoint and phase.",
+            "# TYPE hubspot_merge_retries_total counter"
+        ]
+        lines += [f'hubspot_merge_retries_total{{endpoint="{request["endpoint"]}",phase="{request["phase"]}"}} {request["retries"]}'
+                  for request in summary["endpoints"]]
+        lines += [
+            "# HELP hubspot_merge_request_duration_seconds HTTP request latency.",
+            "# TYPE hubspot_merge_request_duration_seconds histogram"
+        ]
+        for request in summary["endpoints"]:
+            labels = f'endpoint="{request["endpoint"]}",phase="{request["phase"]}"'
+            cumulative = 0
+            for bound, count in request["latency_buckets"].items():
+                cumulative += count
+                lines.append(f'hubspot_merge_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'hubspot_merge_request_duration_seconds_sum{{{labels}}} {request["seconds"]}')
+            lines.append(f'hubspot_merge_request_duration_seconds_count{{{labels}}} {request["count"]}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,55 @@
+import os
+import gzip
+import json
+import threading
+import time
+
+
+class JsonlWriter():
+    # Appends one compact JSON record per line. Writes are buffered and flushed at
+    # most every flush_interval seconds, so a crash loses at most that much output
+    # (the journal still has the progress). The file, and its directory if missing,
+    # are created on the first write.
+    # With stream, records go to an already open file such as stdout, which is
+    # flushed but never closed.
+    def __init__(self, path, gzip_output=False, buffer_size=1024 * 1024, flush_interval=1.0, stream=None):
+        self.path = path + ".gz" if gzip_output and not path.endswith(".gz") else path
+        self.gzip_output = gzip_output
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.stream = stream
+        self.file = stream
+        self.last_flush = time.monotonic()
+        self.count = 0
+
+    def write(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                if self.gzip_output:
+                    self.file = gzip.open(self.path, "at", encoding="utf-8")
+                else:
+                    self.file = open(self.path, "a", encoding="utf-8", buffering=self.buffer_size)
+            self.file.write(line)
+            self.count += 1
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+            elif self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_jsonl(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,52 @@
+import queue
+import threading
+
+# Iterates over the items of a paged API while the next page is already being
+# fetched, so a caller working through a long list of associations waits at most
+# for the first page. Only prefetch pages are held beyond the one being read.
+
+
+class PrefetchingPages():
+    # fetch_page(cursor) returns (items, next_cursor); next_cursor is None on the
+    # last page. Errors of the fetching thread are raised in the reading thread.
+    def __init__(self, fetch_page, cursor=None, prefetch=1):
+        self.fetch_page = fetch_page
+        self.cursor = cursor
+        self.pages = queue.Queue(maxsize=max(1, prefetch))
+        self.stopped = threading.Event()
+        self.fetcher = None
+
+    def fetch(self):
+        cursor = self.cursor
+        try:
+            while not self.stopped.is_set():
+                items, cursor = self.fetch_page(cursor)
+                self.put(("page", items))
+                if cursor is None:
+                    break
+        except Exception as e:
+            self.put(("error", e))
+        self.put(("done", None))
+
+    def put(self, item):
+        # Gives up when the reader has stopped, instead of blocking on a full queue
+        while not self.stopped.is_set():
+            try:
+                self.pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        self.fetcher = threading.Thread(target=self.fetch, daemon=True)
+        self.fetcher.start()
+        try:
+            while True:
+                kind, value = self.pages.get()
+                if kind == "done":
+                    return
+                if kind == "error":
+                    raise value
+                yield from value
+        finally:
+            self.stopped.set()
@@ -0,0 +1,75 @@
+import math
+
+
+def plan_key_associations(companies_with_child_parent):
+    # Works out the smallest set of association changes for one key. Edges are
+    # (child_id, parent_id) pairs.
+    #
+    # - Edges of the companies being merged are detached: the merge would drop them
+    #   or fail on a second parent. Edges between companies of the same key are
+    #   detached too, since after the merge they would point at the kept company.
+    # - Edges of the kept company to other companies are left in place.
+    # - Afterwards only the children the kept company does not already have are
+    #   created, once each, plus the parent of a merged company if the kept company
+    #   has none.
+    target_company = next(company for company in companies_with_child_parent if company["action"] == "keep")
+    merged = [company for company in companies_with_child_parent if company["action"] != "keep"]
+    key_company_ids = {str(company["id"]) for company in companies_with_child_parent}
+    target_id = target_company["id"]
+
+    detach = []
+    for company in merged:
+        detach += [(child_id, company["id"]) for child_id in company["child_companies"]]
+        detach += [(company["id"], parent_id) for parent_id in company["parent_companies"]]
+    detach += [(child_id, target_id) for child_id in target_company["child_companies"] if str(child_id) in key_company_ids]
+    detach += [(target_id, parent_id) for parent_id in target_company["parent_companies"] if str(parent_id) in key_company_ids]
+    detach = unique_edges(detach)
+
+    child_companies = [child_id for child_id in target_company["child_companies"] if str(child_id) not in key_company_ids]
+    known_children = {str(child_id) for child_id in child_companies}
+    attach = []
+    for company in merged:
+        for child_id in company["child_companies"]:
+            if str(child_id) not in key_company_ids and str(child_id) not in known_children:
+                known_children.add(str(child_id))
+                child_companies.append(child_id)
+                attach.append((child_id, target_id))
+
+    parent_companies = [parent_id for parent_id in target_company["parent_companies"] if str(parent_id) not in key_company_ids]
+    if not parent_companies:
+        for company in merged:
+            parents = [parent_id for parent_id in company["parent_companies"] if str(parent_id) not in key_company_ids]
+            if parents:
+                parent_companies = parents[:1]
+                attach.append((target_id, parents[0]))
+                break
+
+    return {
+        "detach": detach,
+        "merges": [(company["id"], target_id) for company in merged],
+        "attach": attach,
+        "child_companies": child_companies,
+        "parent_companies": parent_companies
+    }
+
+
+def unique_edges(edges):
+    seen = set()
+    unique = []
+    for child_id, parent_id in edges:
+        edge = (str(child_id), str(parent_id))
+        if edge not in seen:
+            seen.add(edge)
+            unique.append((child_id, parent_id))
+    return unique
+
+
+def count_plan_calls(plan, batch_size):
+    detach_calls = math.ceil(len(plan["detach"]) / batch_size)
+    attach_calls = math.ceil(len(plan["attach"]) / batch_size)
+    return {
+        "detach": detach_calls,
+        "merge": len(plan["merges"]),
+        "attach": attach_calls,
+        "total": detach_calls + len(plan["merges"]) + attach_calls
+    }
@@ -0,0 +1,147 @@
+import re
+import time
+import random
+import logging
+import threading
+
+DEFAULT_RATE_INTERVAL = 10
+
+# Calls that can be sent again after an error without changing the result twice.
+# Reads, and association writes: creating an association that exists or archiving
+# one that is gone does nothing. Merges are not in the list: a merge whose
+# response was lost may have happened.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+IDEMPOTENT_POST_PATHS = re.compile(r"/batch/read$|/associations/.+/batch/(create|archive|labels/archive)$")
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_idempotent(method, path):
+    return method in IDEMPOTENT_METHODS or (method == "POST" and IDEMPOTENT_POST_PATHS.search(path.split("?")[0]) is not None)
+
+
+class RateGovernor():
+    # Paces the requests of every thread using a transport and decides when a
+    # failed request is sent again.
+    #
+    # - A token bucket allows rate_limit requests per rate_interval seconds. The
+    #   X-HubSpot-RateLimit-* headers of each response set its size and what is
+    #   left, so other clients using the same token are taken into account. Without
+    #   a rate_limit, requests are only paced once the headers give one.
+    # - A 429 stops all requests until its Retry-After has passed.
+    # - The number of requests in flight is adjusted AIMD style: it grows by about
+    #   one for every in_flight_limit successful requests and halves on a 429, so
+    #   concurrent workers settle just below the portal's limit.
+    # - A 429 is always retried, since HubSpot did not act on the request. Other
+    #   errors (5xx, timeouts) are retried only for idempotent calls. Retries wait
+    #   a random time up to an exponentially growing bound ("full jitter").
+    def __init__(self, rate_limit=None, rate_interval=DEFAULT_RATE_INTERVAL, max_in_flight=10, min_in_flight=1,
+                 max_retries=5, backoff_base=0.5, backoff_max=30):
+        self.capacity = float(rate_limit) if rate_limit else None
+        self.rate = rate_limit / rate_interval if rate_limit else None
+        self.tokens = float(rate_limit) if rate_limit else 0.0
+        self.updated_at = time.monotonic()
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.in_flight_limit = float(max_in_flight)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.condition = threading.Condition()
+        self.counts = {"requests": 0, "throttled": 0, "retries": 0, "waited_seconds": 0.0}
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        # Blocks until a request may be sent; returns the time it was sent, to be
+        # passed to release()
+        waited_from = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.in_flight >= max(self.min_in_flight, int(self.in_flight_limit)):
+                    wait = None
+                elif self.rate and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens = max(0.0, self.tokens - 1)
+                    self.in_flight += 1
+                    self.counts["requests"] += 1
+                    self.counts["waited_seconds"] += now - waited_from
+                    return now
+                self.condition.wait(wait)
+
+    def release(self, sent_at, status_code=None, headers=None):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if headers:
+                self.update_from_headers(headers, now)
+            if status_code == 429:
+                self.counts["throttled"] += 1
+                retry_after = self.retry_after(headers)
+                self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after is not None else self.backoff_base))
+                self.tokens = 0.0
+                # Only one decrease per burst: requests sent before the last decrease
+                # were sent under the old limit
+                if sent_at >= self.last_decrease:
+                    self.in_flight_limit = max(float(self.min_in_flight), self.in_flight_limit / 2)
+                    self.last_decrease = now
+                    logging.info(f"Rate limited by HubSpot; allowing {int(self.in_flight_limit)} requests in flight")
+            elif status_code is not None and status_code < 500:
+                self.in_flight_limit = min(float(self.max_in_flight), self.in_flight_limit + 1 / self.in_flight_limit)
+            self.condition.notify_all()
+
+    def update_from_headers(self, headers, now):
+        limit = headers.get("X-HubSpot-RateLimit-Max")
+        remaining = headers.get("X-HubSpot-RateLimit-Remaining")
+        interval = headers.get("X-HubSpot-RateLimit-Interval-Milliseconds")
+        try:
+            if limit and interval:
+                if self.rate is None:
+                    self.tokens = float(limit)
+                self.capacity = float(limit)
+                self.rate = float(limit) / (float(interval) / 1000)
+            if remaining is not None and self.rate:
+                self.refill(now)
+                self.tokens = min(self.tokens, float(remaining))
+        except ValueError:
+            pass
+        if headers.get("X-HubSpot-RateLimit-Daily-Remaining") == "0":
+            logging.warning("The daily HubSpot API limit of this token is used up")
+
+    def retry_after(self, headers):
+        try:
+            return float(headers.get("Retry-After")) if headers and headers.get("Retry-After") else None
+        except ValueError:
+            return None
+
+    def retry_delay(self, method, path, status_code, attempt, headers=None):
+        # Seconds to wait before sending the request again, or None if it should not
+        # be. status_code is None when no response was received.
+        if attempt > self.max_retries:
+            return None
+        if status_code is not None and status_code not in RETRY_STATUS_CODES:
+            return None
+        if status_code != 429 and not is_idempotent(method, path):
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if status_code == 429:
+            # acquire() also waits out the Retry-After; the jitter spreads the
+            # retries of the threads that were throttled together
+            delay = max(delay, self.retry_after(headers) or 0)
+        with self.condition:
+            self.counts["retries"] += 1
+        return delay
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counts, waited_seconds=round(self.counts["waited_seconds"], 3), in_flight_limit=int(self.in_flight_limit))
@@ -0,0 +1,215 @@
+import sys
+import bisect
+from enum import Enum
+from array import array
+from collections.abc import Mapping, ItemsView
+
+
+class Action(Enum):
+    KEEP = "keep"
+    MERGE = "merge"
+
+
+ACTIONS = [Action.KEEP, Action.MERGE]
+ACTION_CODES = {Action.KEEP: 0, Action.MERGE: 1}
+OTHER_ACTION = -1
+TEXT_ID = 0
+
+
+def parse_company_id(company_id):
+    # Plain numbers become ints; anything that would not print back the same (signs,
+    # spaces, leading zeros, more than 18 digits) stays text
+    if company_id.isdigit() and len(company_id) <= 18 and (company_id == "0" or company_id[0] != "0"):
+        return int(company_id)
+    return company_id
+
+
+def parse_action(action):
+    # Unknown actions stay text so that validation can report them
+    action = action.lower()
+    try:
+        return Action(action)
+    except ValueError:
+        return sys.intern(action)
+
+
+class CompanyRecord():
+    # One input row. Numeric ids are ints and valid actions are Actions. Indexing
+    # by the CSV field names gives the same strings as a csv.DictReader row (with
+    # the action lowercased), so code written for row dicts works unchanged.
+    __slots__ = ("company_id", "company_name", "key", "action", "row_number")
+    FIELDS = ("id", "company_name", "key", "action")
+
+    def __init__(self, company_id, company_name, key, action, row_number=None):
+        self.company_id = company_id
+        self.company_name = company_name
+        self.key = key
+        self.action = action
+        self.row_number = row_number
+
+    @classmethod
+    def from_row(cls, row, row_number=None):
+        return cls(parse_company_id(row["id"]), row["company_name"], row["key"], parse_action(row["action"]), row_number)
+
+    def __getitem__(self, field):
+        if field == "id":
+            return str(self.company_id)
+        if field == "company_name":
+            return self.company_name
+        if field == "key":
+            return self.key
+        if field == "action":
+            return self.action.value if isinstance(self.action, Action) else self.action
+        raise KeyError(field)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return [(field, self[field]) for field in self.FIELDS]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return isinstance(other, CompanyRecord) and self.items() == other.items()
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class KeyRowsView(ItemsView):
+    # items() of a RecordStore or ColumnarInput. Iterating reads the keys in order
+    # by position, one key at a time, instead of looking each key up.
+    def __iter__(self):
+        return self._mapping.iter_items()
+
+
+class RecordStore(Mapping):
+    # Input rows in columns, grouped by key: the rows of the i-th key are
+    # key_starts[i] to key_starts[i + 1]. Keys keep the order in which they first
+    # appear. Names and keys are stored once each. A key's rows only become
+    # CompanyRecords when the key is read, so the store costs about 17 bytes per row
+    # plus one string per distinct name and key.
+    def __init__(self):
+        self.company_ids = array("Q")
+        self.name_indexes = array("I")
+        self.actions = array("b")
+        self.row_numbers = array("I")
+        self.names = []
+        self.keys_in_order = []
+        self.key_starts = array("I", [0])
+        self.key_positions = None
+        # (row, field) -> text of ids and actions that do not fit their column
+        self.other_values = {}
+
+    @classmethod
+    def from_rows(cls, rows, first_row_number=2):
+        # Rows may come in any key order. They are appended as they are read, with
+        # the number of their key, and then put in key order with a stable sort.
+        staged = cls()
+        name_lookup = {}
+        key_lookup = {}
+        key_codes = array("I")
+        for row_number, row in enumerate(rows, start=first_row_number):
+            row_index = len(staged.company_ids)
+            company_id = parse_company_id(row["id"])
+            if isinstance(company_id, int):
+                staged.company_ids.append(company_id)
+            else:
+                staged.company_ids.append(TEXT_ID)
+                staged.other_values[(row_index, "id")] = company_id
+            action = parse_action(row["action"])
+            if isinstance(action, Action):
+                staged.actions.append(ACTION_CODES[action])
+            else:
+                staged.actions.append(OTHER_ACTION)
+                staged.other_values[(row_index, "action")] = action
+            name = row["company_name"]
+            name_index = name_lookup.get(name)
+            if name_index is None:
+                name_index = name_lookup[name] = len(staged.names)
+                staged.names.append(name)
+            staged.name_indexes.append(name_index)
+            staged.row_numbers.append(row_number)
+            key = row["key"]
+            key_code = key_lookup.get(key)
+            if key_code is None:
+                key_code = key_lookup[key] = len(staged.keys_in_order)
+                staged.keys_in_order.append(key)
+            key_codes.append(key_code)
+        del name_lookup, key_lookup
+
+        store = cls()
+        store.names = staged.names
+        store.keys_in_order = staged.keys_in_order
+        key_counts = array("I", [0]) * len(store.keys_in_order)
+        for key_code in key_codes:
+            key_counts[key_code] += 1
+        for count in key_counts:
+            store.key_starts.append(store.key_starts[-1] + count)
+        if all(key_codes[row_index] <= key_codes[row_index + 1] for row_index in range(len(key_codes) - 1)):
+            # Already grouped by key, as the input usually is
+            order = range(len(key_codes))
+        else:
+            order = array("I", sorted(range(len(key_codes)), key=key_codes.__getitem__))
+        del key_codes
+        store.company_ids = array("Q", map(staged.company_ids.__getitem__, order))
+        store.name_indexes = array("I", map(staged.name_indexes.__getitem__, order))
+        store.actions = array("b", map(staged.actions.__getitem__, order))
+        store.row_numbers = array("I", map(staged.row_numbers.__getitem__, order))
+        if staged.other_values:
+            new_positions = {row_index: position for position, row_index in enumerate(order)}
+            store.other_values = {(new_positions[row_index], field): value for (row_index, field), value in staged.other_values.items()}
+        return store
+
+    def record(self, row_index, key=None):
+        if key is None:
+            key = self.keys_in_order[self.key_position(row_index)]
+        company_id = self.other_values.get((row_index, "id"), self.company_ids[row_index])
+        action_code = self.actions[row_index]
+        action = ACTIONS[action_code] if action_code != OTHER_ACTION else self.other_values[(row_index, "action")]
+        return CompanyRecord(company_id, self.names[self.name_indexes[row_index]], key, action, self.row_numbers[row_index])
+
+    def key_position(self, row_index):
+        return bisect.bisect_right(self.key_starts, row_index) - 1
+
+    def key_ranges(self):
+        for position, key in enumerate(self.keys_in_order):
+            yield key, self.key_starts[position], self.key_starts[position + 1]
+
+    def records(self, start, end, key):
+        return [self.record(row_index, key) for row_index in range(start, end)]
+
+    def action_counts(self, start, end):
+        actions = self.actions[start:end]
+        return {"keep": actions.count(ACTION_CODES[Action.KEEP]), "merge": actions.count(ACTION_CODES[Action.MERGE]), "rows": end - start}
+
+    def items(self):
+        return KeyRowsView(self)
+
+    def iter_items(self):
+        for key, start, end in self.key_ranges():
+            yield key, self.records(start, end, key)
+
+    def __getitem__(self, key):
+        if self.key_positions is None:
+            self.key_positions = {key: position for position, key in enumerate(self.keys_in_order)}
+        position = self.key_positions[key]
+        return self.records(self.key_starts[position], self.key_starts[position + 1], key)
+
+    def __iter__(self):
+        return iter(self.keys_in_order)
+
+    def __len__(self):
+        return len(self.keys_in_order)
+
+    @property
+    def row_count(self):
+        return len(self.company_ids)
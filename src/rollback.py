@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from main import HubspotAPI, read_access_token, ASSOCIATION_BATCH_SIZE
+from journal import MergeJournal
+from output_writer import JsonlWriter, read_jsonl
+
+# Puts back the parent/child associations a merge run found, using the run's
+# pre-merge snapshot (data/intermediate/pre_merge_*.jsonl, .jsonl.gz or the
+# converted .json) or its journal (data/journal/*.sqlite):
+#
+#   python rollback.py data/intermediate/pre_merge_20240101_120000.jsonl --dry-run
+#   python rollback.py data/journal/input_data.sqlite --workers 8
+#
+# Merged companies no longer exist, so their edges are restored on the company
+# they were merged into. A company counts as merged if the journal recorded its
+# merge or HubSpot's batch read returns it as merged into another company; every
+# other company, such as the merge company of a key that stopped before its merge,
+# gets its own edges back. Only edges that are missing now are created. A company
+# can have one parent: if a company has a different parent now, or the snapshot
+# gives it more than one parent after merging, the edge is reported as a conflict
+# and left alone. Every key's restored edges, conflicts and errors are written to
+# data/outputs/rollback_<timestamp>.jsonl.
+
+
+def read_snapshot(path):
+    # (key, companies with child_companies and parent_companies) of every key, and
+    # the merges the journal recorded (company id -> the company it went into)
+    if path.endswith((".sqlite", ".db")):
+        if not os.path.exists(path):
+            error_message = f"Journal {path} does not exist"
+            logging.error(error_message)
+            raise Exception(error_message)
+        # resume=True, or the journal would be emptied
+        journal = MergeJournal(path, resume=True)
+        try:
+            return [(key, companies) for key, companies in journal.iter_phase("enriched")], journal.merged_into()
+        finally:
+            journal.close()
+    if path.endswith(".json"):
+        with open(path, mode='r', encoding='utf-8') as file:
+            records = json.load(file)
+    else:
+        records = read_jsonl(path)
+    keys = []
+    for record in records:
+        companies = record["companies"] if isinstance(record, dict) else record
+        if companies:
+            keys.append((str(record["key"]) if isinstance(record, dict) else str(companies[0]["key"]), companies))
+    return keys, {}
+
+
+def survivor_ids(merged_into):
+    # Each merged company maps to the company it was merged into. Chains (A into
+    # B, later B into C) are followed to the end.
+    def resolve(company_id):
+        seen = set()
+        company_id = str(company_id)
+        while company_id in merged_into and company_id not in seen:
+            seen.add(company_id)
+            company_id = str(merged_into[company_id])
+        return company_id
+    return resolve
+
+
+def expected_edges(keys, resolve):
+    # Edges (child_id, parent_id) each key's companies had before the merge, on
+    # the surviving companies. The kept company's edges come first, so its own
+    # parent wins over the parent of a company merged into it.
+    key_edges = []
+    for key, companies in keys:
+        edges = []
+        for company in sorted(companies, key=lambda company: company["action"] != "keep"):
+            company_id = resolve(company["id"])
+            edges += [(resolve(child_id), company_id) for child_id in company.get("child_companies", [])]
+            edges += [(company_id, resolve(parent_id)) for parent_id in company.get("parent_companies", [])]
+        key_edges.append((key, list(dict.fromkeys(edge for edge in edges if edge[0] != edge[1]))))
+    return key_edges
+
+
+class Rollback():
+    def __init__(self, hubspot_client, workers=8, report_interval=10):
+        self.hubspot_client = hubspot_client
+        self.workers = workers
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.done = {"edges": 0, "errors": 0}
+        self.total = 0
+        self.started_at = None
+        self.last_report = 0
+
+    def merged_companies(self, keys, merged_into):
+        # The journal's merges, plus the companies of the keys and their edges that
+        # HubSpot returns as merged into another company
+        company_ids = set()
+        for key, companies in keys:
+            for company in companies:
+                company_ids.add(str(company["id"]))
+                company_ids.update(str(company_id) for company_id in company.get("child_companies", []))
+                company_ids.update(str(company_id) for company_id in company.get("parent_companies", []))
+        redirected = self.hubspot_client.check_companies_exist(sorted(company_ids - set(merged_into)))[1]
+        return dict(redirected, **merged_into)
+
+    def current_parents(self, child_ids):
+        # Current parents of each child, read in batches on all workers
+        child_ids = list(dict.fromkeys(child_ids))
+        batches = [child_ids[start:start + ASSOCIATION_BATCH_SIZE] for start in range(0, len(child_ids), ASSOCIATION_BATCH_SIZE)]
+        parents = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for associations in executor.map(self.hubspot_client.load_associations, batches):
+                for company_id, company_associations in associations.items():
+                    parents[company_id] = {str(parent_id) for parent_id in company_associations["parent_companies"]}
+        return parents
+
+    def plan(self, key_edges):
+        parents = self.current_parents(child_id for key, edges in key_edges for child_id, parent_id in edges)
+        # The parent each child ends up with, current or restored
+        assigned = {child_id: next(iter(child_parents)) if len(child_parents) == 1 else None for child_id, child_parents in parents.items() if child_parents}
+        plans = []
+        for key, edges in key_edges:
+            plan = {"key": key, "restore": [], "present": 0, "conflicts": []}
+            for child_id, parent_id in edges:
+                if parent_id in parents.get(child_id, ()):
+                    plan["present"] += 1
+                elif child_id in assigned:
+                    plan["conflicts"].append({"child_id": child_id, "parent_id": parent_id,
+                                              "current_parent_ids": sorted(parents.get(child_id, ())) or [assigned[child_id]]})
+                else:
+                    assigned[child_id] = parent_id
+                    plan["restore"].append((child_id, parent_id))
+            plans.append(plan)
+        return plans
+
+    def restore_batch(self, batch):
+        errors = self.hubspot_client.create_associations(batch)
+        with self.lock:
+            self.done["edges"] += len(batch)
+            self.done["errors"] += len(errors)
+            if time.monotonic() - self.last_report >= self.report_interval:
+                self.last_report = time.monotonic()
+                logging.info(self.progress_line())
+        return errors
+
+    def progress_line(self):
+        elapsed = time.monotonic() - self.started_at
+        edges_per_second = self.done["edges"] / elapsed if elapsed else 0.0
+        line = f"Rollback: {self.done['edges']}/{self.total} edges ({self.done['errors']} failed), {edges_per_second:.1f} edges/sec"
+        if edges_per_second:
+            remaining = (self.total - self.done["edges"]) / edges_per_second
+            line += f", ETA {int(remaining // 3600):02d}:{int(remaining % 3600 // 60):02d}:{int(remaining % 60):02d}"
+        return line
+
+    def apply(self, plans):
+        # All keys' edges are written together in full batches, several batches at a time
+        edges = [edge for plan in plans for edge in plan["restore"]]
+        self.total = len(edges)
+        self.started_at = self.last_report = time.monotonic()
+        batches = [edges[start:start + ASSOCIATION_BATCH_SIZE] for start in range(0, len(edges), ASSOCIATION_BATCH_SIZE)]
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for errors in executor.map(self.restore_batch, batches):
+                for error in errors:
+                    failed[(str(error["child_id"]), str(error["parent_id"]))] = error["error"]
+        logging.info(self.progress_line())
+        for plan in plans:
+            plan["errors"] = [{"child_id": child_id, "parent_id": parent_id, "error": failed[(child_id, parent_id)]}
+                              for child_id, parent_id in plan["restore"] if (child_id, parent_id) in failed]
+        return failed
+
+
+def run_rollback(snapshot_path, hubspot_client, journal_path=None, keys=None, workers=8, dry_run=False, report_interval=10):
+    key_companies, merged_into = read_snapshot(snapshot_path)
+    if journal_path:
+        merged_into.update(read_snapshot(journal_path)[1])
+    if keys:
+        keys = {str(key) for key in keys}
+        key_companies = [(key, companies) for key, companies in key_companies if key in keys]
+    rollback = Rollback(hubspot_client, workers=workers, report_interval=report_interval)
+    key_edges = expected_edges(key_companies, survivor_ids(rollback.merged_companies(key_companies, merged_into)))
+    logging.info(f"Snapshot has {sum(len(edges) for key, edges in key_edges)} edges in {len(key_edges)} keys")
+
+    plans = rollback.plan(key_edges)
+    summary = {
+        "keys": len(plans),
+        "present": sum(plan["present"] for plan in plans),
+        "restore": sum(len(plan["restore"]) for plan in plans),
+        "conflicts": sum(len(plan["conflicts"]) for plan in plans),
+        "dry_run": dry_run
+    }
+    logging.info(f"{summary['present']} edges are in place, {summary['restore']} to restore, {summary['conflicts']} conflicts")
+    if not dry_run and summary["restore"]:
+        summary["failed"] = len(rollback.apply(plans))
+
+    report_path = f"{hubspot_client.output_dir}/outputs/rollback_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+    writer = JsonlWriter(report_path)
+    try:
+        for plan in plans:
+            if plan["restore"] or plan["conflicts"]:
+                writer.write(plan)
+    finally:
+        writer.close()
+    summary["report"] = report_path
+    logging.info(f"Rollback report written to {report_path}")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Restore the associations a merge run changed, from its pre-merge snapshot or journal")
+    parser.add_argument("snapshot", help="pre_merge_*.jsonl(.gz) or .json file, or a journal .sqlite file")
+    parser.add_argument("--journal", help="Journal of the same run, for merges across keys (with --clusters)")
+    parser.add_argument("--keys", help="Comma-separated keys to roll back (default: all)")
+    parser.add_argument("--workers", type=int, default=8, help="Number of batches written at the same time")
+    parser.add_argument("--dry-run", action="store_true", help="Only write the report of what would be restored")
+    parser.add_argument("--token-file", help="File holding the access token (default: HUBSPOT_ACCESS_TOKEN or the env file)")
+    parser.add_argument("--test", action="store_true", help="Use env_test.env for the access token")
+    parser.add_argument("--output-dir", default="./data", help="Directory whose outputs folder gets the report")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    os.makedirs(os.path.join(args.output_dir, "outputs"), exist_ok=True)
+    hubspot_client = HubspotAPI(test=args.test, api_key=read_access_token(args.token_file) if args.token_file else None,
+                                max_workers=args.workers, output_dir=args.output_dir, progress_interval=0)
+    summary = run_rollback(args.snapshot, hubspot_client, journal_path=args.journal, keys=args.keys.split(",") if args.keys else None,
+                           workers=args.workers, dry_run=args.dry_run)
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,105 @@
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class KeyScheduler():
+    def __init__(self, max_workers=1, max_pending=None):
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max_pending or self.max_workers * 4
+        self.condition = threading.Condition()
+        self.held = {}
+        self.held_by_owner = {}
+
+    # Company locks. A key holds the locks of every company it touches (its own
+    # companies and their parents/children) for as long as it is running, so two
+    # keys that share a company or an associated company never overlap.
+    def acquire(self, company_ids):
+        owner = threading.get_ident()
+        company_ids = set(company_ids)
+        with self.condition:
+            self.condition.wait_for(lambda: self._is_free(company_ids, owner))
+            self._hold(company_ids, owner)
+
+    def try_acquire(self, company_ids):
+        owner = threading.get_ident()
+        company_ids = set(company_ids)
+        with self.condition:
+            if not self._is_free(company_ids, owner):
+                return False
+            self._hold(company_ids, owner)
+            return True
+
+    def acquire_free(self, company_ids):
+        # Locks the companies no other key holds, without waiting, and returns them
+        owner = threading.get_ident()
+        with self.condition:
+            free = {company_id for company_id in set(company_ids) if self._is_free({company_id}, owner)}
+            self._hold(free, owner)
+            return free
+
+    def held_ids(self):
+        with self.condition:
+            return set(self.held_by_owner.get(threading.get_ident(), set()))
+
+    def release(self):
+        owner = threading.get_ident()
+        with self.condition:
+            for company_id in self.held_by_owner.pop(owner, set()):
+                del self.held[company_id]
+            self.condition.notify_all()
+
+    def _is_free(self, company_ids, owner):
+        return all(self.held.get(company_id, owner) == owner for company_id in company_ids)
+
+    def _hold(self, company_ids, owner):
+        for company_id in company_ids:
+            self.held[company_id] = owner
+        self.held_by_owner.setdefault(owner, set()).update(company_ids)
+
+    def run(self, grouped_items, process_key):
+        # Keys that share a company id keep their input order: each key waits for
+        # the previous key that touched any of its companies before it starts.
+        last_future_for_company = {}
+        pending = set()
+        index_lock = threading.Lock()
+        failed = threading.Event()
+        errors = []
+
+        def on_done(future, company_ids):
+            with index_lock:
+                for company_id in company_ids:
+                    if last_future_for_company.get(company_id) is future:
+                        del last_future_for_company[company_id]
+            if future.exception() is not None:
+                errors.append(future.exception())
+                failed.set()
+
+        def run_key(key, companies, dependencies):
+            wait(dependencies)
+            if failed.is_set():
+                return None
+            return process_key(key, companies)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="merge") as executor:
+            for key, companies in grouped_items:
+                if failed.is_set():
+                    break
+                if len(pending) >= self.max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    pending.difference_update(done)
+
+                company_ids = {company["id"] for company in companies}
+                with index_lock:
+                    dependencies = {last_future_for_company[company_id] for company_id in company_ids if company_id in last_future_for_company}
+                    future = executor.submit(run_key, key, companies, dependencies)
+                    for company_id in company_ids:
+                        last_future_for_company[company_id] = future
+                future.add_done_callback(lambda f, ids=company_ids: on_done(f, ids))
+                pending.add(future)
+
+            wait(pending)
+
+        if errors:
+            logging.error(f"Merge stopped after a failed key: {errors[0]}")
+            raise errors[0]
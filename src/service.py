@@ -0,0 +1,326 @@
+import os
+import io
+import csv
+import json
+import uuid
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from main import HubspotAPI, read_access_token, ASSOCIATION_WRITE_WORKERS
+from journal import MergeJournal
+from metrics import MergeMetrics, phase_metrics
+from scheduler import KeyScheduler
+from transport import HubspotTransport
+from rate_governor import RateGovernor
+from association_cache import AssociationCache
+from output_writer import read_jsonl
+from validate_csv import ValidateCSV, ValidationError
+
+# Long-running merge service. Jobs are submitted over a small local HTTP API, kept
+# in a SQLite queue, and run by a pool of workers that share one connection pool,
+# one association cache and one set of company locks, so connections and cached
+# associations stay warm from one job to the next.
+#
+#   POST /jobs                 CSV (id,company_name,key,action) or JSON:
+#                              {"rows": [{"id", "company_name", "key", "action"}, ...]}
+#                              {"pairs": [{"keep": id, "merge": id, "key": optional}, ...]}
+#   GET  /jobs                 latest jobs
+#   GET  /jobs/<id>            status and summary of a job
+#   GET  /jobs/<id>/results    merged companies and skipped keys, as JSON Lines
+#   GET  /metrics              HTTP calls of all jobs, in the Prometheus text format
+#   GET  /health
+
+JOB_STATUSES = ["queued", "running", "completed", "failed"]
+
+
+class JobQueue():
+    # Jobs survive a restart: jobs that were running when the service stopped are
+    # queued again and resume from their journals.
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                keys INTEGER NOT NULL,
+                rows TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                submitted_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT,
+                summary TEXT,
+                error TEXT
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted_at)")
+
+    def submit(self, rows):
+        job_id = uuid.uuid4().hex
+        keys = len({row["key"] for row in rows})
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO jobs (id, status, keys, rows, submitted_at) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, keys, json.dumps(rows), datetime.now().isoformat())
+            )
+        return job_id
+
+    def claim(self):
+        # The oldest queued job, marked as running
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, rows, attempts FROM jobs WHERE status = 'queued' ORDER BY submitted_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+            job_id, rows, attempts = row
+            self.connection.execute(
+                "UPDATE jobs SET status = 'running', attempts = ?, started_at = ? WHERE id = ?",
+                (attempts + 1, datetime.now().isoformat(), job_id)
+            )
+        return {"id": job_id, "rows": json.loads(rows), "attempts": attempts + 1}
+
+    def finish(self, job_id, status, summary=None, error=None):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, summary = ?, error = ? WHERE id = ?",
+                (status, datetime.now().isoformat(), json.dumps(summary) if summary is not None else None, error, job_id)
+            )
+
+    def requeue_running(self):
+        with self.lock:
+            return self.connection.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, status, keys, attempts, submitted_at, started_at, finished_at, summary, error FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+        return self.job_dict(row) if row else None
+
+    def latest(self, limit=100):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, status, keys, attempts, submitted_at, started_at, finished_at, summary, error FROM jobs ORDER BY submitted_at DESC LIMIT ?",
+                (limit,)).fetchall()
+        return [self.job_dict(row) for row in rows]
+
+    def counts(self):
+        with self.lock:
+            counts = dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in JOB_STATUSES}
+
+    def job_dict(self, row):
+        job_id, status, keys, attempts, submitted_at, started_at, finished_at, summary, error = row
+        return {"id": job_id, "status": status, "keys": keys, "attempts": attempts, "submitted_at": submitted_at,
+                "started_at": started_at, "finished_at": finished_at,
+                "summary": json.loads(summary) if summary else None, "error": error}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def parse_job(body, content_type):
+    # Rows of a submitted job, validated like an input file
+    if "json" in content_type:
+        payload = json.loads(body)
+        if isinstance(payload, dict) and "pairs" in payload:
+            rows = []
+            for number, pair in enumerate(payload["pairs"], start=1):
+                key = str(pair.get("key", number))
+                rows.append({"id": str(pair["merge"]), "company_name": str(pair.get("merge_name", "")), "key": key, "action": "merge"})
+                rows.append({"id": str(pair["keep"]), "company_name": str(pair.get("keep_name", "")), "key": key, "action": "keep"})
+        else:
+            rows = payload["rows"] if isinstance(payload, dict) else payload
+            rows = [{field: str(row.get(field, "")) for field in ("id", "company_name", "key", "action")} for row in rows]
+    else:
+        rows = list(csv.DictReader(io.StringIO(body)))
+    for row in rows:
+        row["action"] = row["action"].lower()
+    if not rows:
+        raise ValidationError("The job has no rows", [])
+    ValidateCSV(rows)
+    return rows
+
+
+class MergeService():
+    def __init__(self, access_token, service_dir="./data/service", job_workers=1, key_workers=4,
+                 base_url="https://api.hubapi.com", cache_ttl=3600, cache_size=100000, cache_path=None):
+        self.access_token = access_token
+        self.service_dir = service_dir
+        self.job_workers = job_workers
+        self.key_workers = key_workers
+        os.makedirs(os.path.join(service_dir, "jobs"), exist_ok=True)
+        self.queue = JobQueue(os.path.join(service_dir, "jobs.sqlite"))
+        # Shared by every job
+        self.metrics = MergeMetrics(report_interval=0)
+        self.governor = RateGovernor(max_in_flight=job_workers * key_workers * ASSOCIATION_WRITE_WORKERS)
+        self.transport = HubspotTransport(access_token, base_url=base_url, pool_size=max(10, job_workers * key_workers * ASSOCIATION_WRITE_WORKERS),
+                                          listeners=[self.on_response], governor=self.governor)
+        self.association_cache = AssociationCache(ttl=cache_ttl, max_entries=cache_size, path=cache_path)
+        self.scheduler = KeyScheduler(key_workers)
+        self.job_available = threading.Condition()
+        self.stopping = threading.Event()
+        self.workers = []
+
+    def start(self):
+        requeued = self.queue.requeue_running()
+        if requeued:
+            logging.info(f"Queued {requeued} interrupted jobs again")
+        for number in range(self.job_workers):
+            worker = threading.Thread(target=self.work, name=f"job-worker-{number}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        self.stopping.set()
+        with self.job_available:
+            self.job_available.notify_all()
+
+    def submit(self, rows):
+        job_id = self.queue.submit(rows)
+        logging.info(f"Job {job_id} queued with {len(rows)} rows")
+        with self.job_available:
+            self.job_available.notify()
+        return job_id
+
+    def work(self):
+        while not self.stopping.is_set():
+            job = self.queue.claim()
+            if job is None:
+                with self.job_available:
+                    self.job_available.wait(timeout=5)
+                continue
+            self.run_job(job)
+
+    def on_response(self, method, path, status_code, seconds, attempt=1):
+        # Every call counts in the service's metrics, and in the metrics of the job
+        # whose phase the calling thread is in
+        self.metrics.on_response(method, path, status_code, seconds, attempt)
+        job_metrics = phase_metrics()
+        if job_metrics is not None and job_metrics is not self.metrics:
+            job_metrics.on_response(method, path, status_code, seconds, attempt)
+
+    def job_dir(self, job_id):
+        return os.path.join(self.service_dir, "jobs", job_id)
+
+    def run_job(self, job):
+        job_dir = self.job_dir(job["id"])
+        for directory in ("intermediate", "outputs", "errors"):
+            os.makedirs(os.path.join(job_dir, directory), exist_ok=True)
+        logging.info(f"Job {job['id']} started" + (f" (attempt {job['attempts']})" if job["attempts"] > 1 else ""))
+
+        grouped_data = {}
+        for row in job["rows"]:
+            grouped_data.setdefault(row["key"], []).append(row)
+        hubspot_client = HubspotAPI(api_key=self.access_token, max_workers=self.key_workers, output_dir=job_dir,
+                                    transport=self.transport, association_cache=self.association_cache, scheduler=self.scheduler,
+                                    metrics=MergeMetrics(report_interval=0))
+        journal = MergeJournal(os.path.join(job_dir, "journal.sqlite"), resume=job["attempts"] > 1)
+        try:
+            hubspot_client.run_merge(grouped_data, journal=journal, collect_results=False)
+            summary = hubspot_client.metrics.summary()
+            self.queue.finish(job["id"], "completed", {field: summary[field] for field in ("elapsed_seconds", "keys", "keys_per_second", "requests", "requests_per_key", "phases")})
+            logging.info(f"Job {job['id']} completed: {summary['keys']}")
+        except Exception as e:
+            self.queue.finish(job["id"], "failed", error=str(e))
+            logging.error(f"Job {job['id']} failed: {e}")
+        finally:
+            journal.close()
+
+    def iter_results(self, job_id):
+        job_dir = self.job_dir(job_id)
+        for directory in ("outputs", "errors"):
+            path = os.path.join(job_dir, directory)
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                if name.startswith(("merged_", "missing_")) and ".jsonl" in name:
+                    yield from read_jsonl(os.path.join(path, name))
+
+
+def make_handler(service):
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def send_body(self, status, data, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_json(self, status, payload):
+            self.send_body(status, json.dumps(payload).encode("utf-8"))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+            if urlparse(self.path).path.rstrip("/") != "/jobs":
+                return self.send_json(404, {"error": "Not found"})
+            try:
+                rows = parse_job(body, self.headers.get("Content-Type", ""))
+            except ValidationError as e:
+                return self.send_json(400, {"error": f"Validation error: {e}", "validation_errors": e.errors})
+            except (ValueError, KeyError, TypeError) as e:
+                return self.send_json(400, {"error": f"Could not read the job: {e}"})
+            job_id = service.submit(rows)
+            self.send_json(202, service.queue.get(job_id))
+
+        def do_GET(self):
+            parts = [part for part in urlparse(self.path).path.split("/") if part]
+            if parts == ["health"]:
+                return self.send_json(200, {"status": "ok", "jobs": service.queue.counts(), "rate_governor": service.governor.stats()})
+            if parts == ["metrics"]:
+                return self.send_body(200, service.metrics.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4")
+            if parts == ["jobs"]:
+                return self.send_json(200, service.queue.latest())
+            if len(parts) in (2, 3) and parts[0] == "jobs":
+                job = service.queue.get(parts[1])
+                if job is None:
+                    return self.send_json(404, {"error": f"No job {parts[1]}"})
+                if len(parts) == 2:
+                    return self.send_json(200, job)
+                if parts[2] == "results":
+                    data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in service.iter_results(job["id"]))
+                    return self.send_body(200, data.encode("utf-8"), "application/x-ndjson")
+            self.send_json(404, {"error": "Not found"})
+
+    return RequestHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run Hubspot merges as a service with a local HTTP API and a job queue")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token-file", help="File holding the access token (default: HUBSPOT_ACCESS_TOKEN)")
+    parser.add_argument("--service-dir", default="./data/service", help="Directory for the job queue and job outputs")
+    parser.add_argument("--job-workers", type=int, default=1, help="Number of jobs run at the same time")
+    parser.add_argument("--workers", type=int, default=4, help="Number of keys of a job processed concurrently")
+    parser.add_argument("--association-cache", help="SQLite file that keeps loaded associations between restarts")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    service = MergeService(read_access_token(args.token_file), service_dir=args.service_dir, job_workers=args.job_workers,
+                           key_workers=args.workers, cache_path=args.association_cache)
+    service.start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    logging.info(f"Merge service listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Merge service stopping; running jobs continue on the next start")
+    finally:
+        service.stop()
+        server.server_close()
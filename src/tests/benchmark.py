@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import csv
+import tracemalloc
+import multiprocessing
+import requests
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root_dir)
+from main import HubspotAPI
+from records import RecordStore
+from mock_hubspot import MockHubspot, MockHubspotServer, build_graph
+
+# Runs HubspotAPI.run_merge against the local mock HubSpot for synthetic jobs and
+# reports keys/sec, HTTP calls per key and peak Python memory of the merge. The
+# mock runs in its own process, so neither its CPU time nor its memory is counted.
+# tracemalloc slows the merge down several times, so peak memory is measured in a
+# second run of each case.
+#
+#   python benchmark.py --keys 100,1000,10000,100000 --fan-out 0,5 --output bench.json
+#   python benchmark.py --baseline bench.json
+#   python benchmark.py --grouping-memory 1000000
+#
+# With --baseline, the run fails if a case got slower, made more calls per key or
+# used more memory than the baseline allows.
+
+
+def serve_mock(case, input_file, connection):
+    hubspot = MockHubspot(latency=case["latency"], rate_limit=case["rate_limit"], error_rate=case["error_rate"], seed=1)
+    rows = build_graph(hubspot, case["keys"], case["fan_out"])
+    with open(input_file, "w", encoding="utf-8") as file:
+        file.write("id,company_name,key,action\n")
+        for row in rows:
+            file.write(f"{row['id']},{row['company_name']},{row['key']},{row['action']}\n")
+    del rows
+    server = MockHubspotServer(hubspot).start()
+    connection.send(server.url)
+    connection.recv()
+    server.stop()
+
+
+def run_case(case, trace_memory=False):
+    with tempfile.TemporaryDirectory() as directory:
+        for subdirectory in ("intermediate", "outputs", "errors"):
+            os.makedirs(os.path.join(directory, subdirectory))
+        input_file = os.path.join(directory, "input_data.csv")
+        connection, mock_connection = multiprocessing.Pipe()
+        mock_process = multiprocessing.Process(target=serve_mock, args=(case, input_file, mock_connection), daemon=True)
+        mock_process.start()
+        url = connection.recv()
+
+        result = dict(case)
+        try:
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            try:
+                hubspot_client = HubspotAPI(api_key="benchmark", input_file_path=input_file, max_workers=case["workers"],
+                                            base_url=url, output_dir=directory)
+                if case["stream"]:
+                    grouped_data = hubspot_client.iter_grouped_data()
+                else:
+                    grouped_data = hubspot_client.load_and_group_data()
+                hubspot_client.run_merge(grouped_data, collect_results=False)
+                result["missing"] = len(hubspot_client.missing)
+            except Exception as e:
+                result["error"] = str(e)
+            elapsed = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+            stats = requests.get(f"{url}/__mock__/stats").json()
+            connection.send("stop")
+            mock_process.join()
+
+    result.update({
+        "seconds": round(elapsed, 3),
+        "keys_per_second": round(case["keys"] / elapsed, 1),
+        "calls_per_key": round(stats["total_calls"] / case["keys"], 3),
+        "peak_memory_mb": round(peak_memory / 1024 / 1024, 2) if trace_memory else None,
+        "calls": stats["calls"],
+        "status_codes": stats["status_codes"]
+    })
+    return result
+
+
+def measure_grouping(rows):
+    # Memory held by the grouped input of rows rows, as load_and_group_data built
+    # it before the record store (lists of csv.DictReader dicts) and as it is now
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "input_data.csv")
+        with open(input_file, "w", encoding="utf-8") as file:
+            file.write("id,company_name,key,action\n")
+            for row in range(rows):
+                key = row // 2
+                file.write(f"{10000000000 + row},Company {row},key-{key},{'keep' if row % 2 == 0 else 'merge'}\n")
+
+        def group_dicts():
+            with open(input_file, mode='r', encoding='utf-8') as file:
+                data = list(csv.DictReader(file))
+            grouped_data = {}
+            for row in data:
+                row['action'] = row['action'].lower()
+                grouped_data.setdefault(row['key'], []).append(row)
+            return grouped_data
+
+        def group_store():
+            with open(input_file, mode='r', encoding='utf-8') as file:
+                return RecordStore.from_rows(csv.DictReader(file))
+
+        results = {}
+        for name, group in (("dicts", group_dicts), ("record_store", group_store)):
+            start = time.perf_counter()
+            group()
+            seconds = time.perf_counter() - start
+            tracemalloc.start()
+            grouped_data = group()
+            held, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del grouped_data
+            results[name] = {"held_mb": round(held / 1024 / 1024, 1), "peak_mb": round(peak / 1024 / 1024, 1), "seconds": round(seconds, 1)}
+        return results
+
+
+def case_name(result):
+    return f"keys={result['keys']} fan_out={result['fan_out']} workers={result['workers']}"
+
+
+def compare_to_baseline(results, baseline_path, tolerance):
+    with open(baseline_path, mode='r', encoding='utf-8') as file:
+        baseline = {case_name(result): result for result in json.load(file)}
+    regressions = []
+    for result in results:
+        previous = baseline.get(case_name(result))
+        if previous is None:
+            continue
+        if "error" in result and "error" not in previous:
+            regressions.append(f"{case_name(result)}: failed with {result['error']}")
+        if result["keys_per_second"] < previous["keys_per_second"] * (1 - tolerance):
+            regressions.append(f"{case_name(result)}: {result['keys_per_second']} keys/sec, baseline {previous['keys_per_second']}")
+        if result["calls_per_key"] > previous["calls_per_key"] * (1 + tolerance):
+            regressions.append(f"{case_name(result)}: {result['calls_per_key']} calls/key, baseline {previous['calls_per_key']}")
+        if result["peak_memory_mb"] and previous["peak_memory_mb"] and result["peak_memory_mb"] > previous["peak_memory_mb"] * (1 + tolerance):
+            regressions.append(f"{case_name(result)}: {result['peak_memory_mb']} MB peak, baseline {previous['peak_memory_mb']}")
+    return regressions
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark run_merge against a local mock HubSpot")
+    parser.add_argument("--keys", type=parse_list, default=[100, 1000, 10000], help="Comma-separated numbers of keys, e.g. 100,1000,100000")
+    parser.add_argument("--fan-out", type=parse_list, default=[0, 5], help="Comma-separated numbers of child companies per company")
+    parser.add_argument("--workers", type=parse_list, default=[1, 8], help="Comma-separated numbers of workers")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock adds to every request")
+    parser.add_argument("--rate-limit", type=int, help="Requests per 10 seconds the mock allows before answering 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the mock answers with a random 429")
+    parser.add_argument("--stream", action="store_true", help="Read the input with iter_grouped_data instead of load_and_group_data")
+    parser.add_argument("--skip-memory", action="store_true", help="Do not run every case a second time to measure peak memory")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--grouping-memory", type=int, metavar="ROWS", help="Only compare the memory of the grouped input of this many rows")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.grouping_memory:
+        for name, result in measure_grouping(args.grouping_memory).items():
+            print(f"{name:>13}: {result['held_mb']:>8} MB held, {result['peak_mb']:>8} MB peak, {result['seconds']:>6} seconds")
+        sys.exit(0)
+
+    results = []
+    print(f"{'keys':>8} {'fan-out':>8} {'workers':>8} {'seconds':>9} {'keys/sec':>10} {'calls/key':>10} {'peak MB':>9}")
+    for keys in args.keys:
+        for fan_out in args.fan_out:
+            for workers in args.workers:
+                result = run_case({"keys": keys, "fan_out": fan_out, "workers": workers, "latency": args.latency,
+                                   "rate_limit": args.rate_limit, "error_rate": args.error_rate, "stream": args.stream})
+                if not args.skip_memory:
+                    result["peak_memory_mb"] = run_case(result, trace_memory=True)["peak_memory_mb"]
+                results.append(result)
+                print(f"{keys:>8} {fan_out:>8} {workers:>8} {result['seconds']:>9} {result['keys_per_second']:>10} "
+                      f"{result['calls_per_key']:>10} {str(result['peak_memory_mb']):>9}" + (f"  FAILED: {result['error']}" if "error" in result else ""))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,350 @@
+import re
+import csv
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the parts of the HubSpot API the merger uses: companies
+# (single and batch read, create, merge), v1 associations, and v4 batch and
+# paged associations. Latency and 429 responses can be injected, and
+# build_graph() creates synthetic merge jobs with a chosen association fan-out.
+
+CHILD_TYPE_ID = 13
+PARENT_TYPE_ID = 14
+FIRST_COMPANY_ID = 10000000000
+
+
+class MockHubspot():
+    def __init__(self, latency=0.0, rate_limit=None, rate_interval=10, error_rate=0.0, association_page_size=500, seed=None):
+        self.latency = latency
+        # rate_limit requests per rate_interval seconds are allowed; more get a 429,
+        # like HubSpot's ten-secondly limit. error_rate adds random 429s on top.
+        self.rate_limit = rate_limit
+        self.rate_interval = rate_interval
+        self.error_rate = error_rate
+        self.association_page_size = association_page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_times = deque()
+        self.next_company_id = FIRST_COMPANY_ID
+        self.merged_into = {}
+        self.merged_ids = {}
+        self.children = {}
+        self.parents = {}
+        self.calls = {}
+        self.status_codes = {}
+
+    def create_company(self):
+        with self.lock:
+            return self.create_unlocked()
+
+    def associate(self, child_id, parent_id):
+        with self.lock:
+            self.set_edge(child_id, parent_id, True)
+
+    def resolve(self, company_id):
+        company_id = int(company_id)
+        while self.merged_into.get(company_id) is not None:
+            company_id = self.merged_into[company_id]
+        return company_id if company_id in self.merged_into else None
+
+    def set_edge(self, child_id, parent_id, present):
+        child_id, parent_id = int(child_id), int(parent_id)
+        if present:
+            self.children.setdefault(parent_id, set()).add(child_id)
+            self.parents.setdefault(child_id, set()).add(parent_id)
+        else:
+            self.children.get(parent_id, set()).discard(child_id)
+            self.parents.get(child_id, set()).discard(parent_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "status_codes": dict(self.status_codes),
+                "total_calls": sum(self.calls.values()),
+                "companies": sum(1 for merged_into in self.merged_into.values() if merged_into is None),
+                "edges": sum(len(children) for children in self.children.values())
+            }
+
+    def handle(self, method, url, body=None):
+        parsed = urlparse(url)
+        endpoint = method + " " + re.sub(r"/\d+", "/{id}", parsed.path)
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            status, payload, headers = self.check_rate_limit()
+            if status is None:
+                status, payload = self.route(method, parsed.path, parse_qs(parsed.query), body)
+            self.status_codes[str(status)] = self.status_codes.get(str(status), 0) + 1
+        return status, payload, headers
+
+    def check_rate_limit(self):
+        headers = {}
+        if self.rate_limit:
+            now = time.monotonic()
+            while self.request_times and now - self.request_times[0] >= self.rate_interval:
+                self.request_times.popleft()
+            headers = {
+                "X-HubSpot-RateLimit-Max": str(self.rate_limit),
+                "X-HubSpot-RateLimit-Remaining": str(max(0, self.rate_limit - len(self.request_times) - 1)),
+                "X-HubSpot-RateLimit-Interval-Milliseconds": str(int(self.rate_interval * 1000))
+            }
+            if len(self.request_times) >= self.rate_limit:
+                retry_after = self.rate_interval - (now - self.request_times[0])
+                headers["Retry-After"] = str(max(1, round(retry_after)))
+                return 429, self.rate_limit_error(), headers
+            self.request_times.append(now)
+        if self.error_rate and self.random.random() < self.error_rate:
+            headers["Retry-After"] = "1"
+            return 429, self.rate_limit_error(), headers
+        return None, None, headers
+
+    def rate_limit_error(self):
+        return {"status": "error", "message": "You have reached your ten_secondly_rolling limit.",
+                "category": "RATE_LIMITS", "policyName": "TEN_SECONDLY_ROLLING"}
+
+    def route(self, method, path, query, body):
+        match = re.fullmatch(r"/crm/v3/objects/companies/(\d+)", path)
+        if match and method == "GET":
+            return self.get_company(match.group(1))
+        if path == "/crm/v3/objects/companies" and method == "POST":
+            return 201, {"id": str(self.create_unlocked()), "properties": (body or {}).get("properties", {})}
+        if path == "/crm/v3/objects/companies/batch/read" and method == "POST":
+            return self.batch_read_companies(body)
+        if path == "/crm/v3/objects/companies/merge" and method == "POST":
+            return self.merge(body)
+        match = re.fullmatch(r"/crm-associations/v1/associations/(\d+)/HUBSPOT_DEFINED/(\d+)", path)
+        if match and method == "GET":
+            return self.v1_associations(int(match.group(1)), int(match.group(2)), query)
+        if path == "/crm-associations/v1/associations" and method == "PUT":
+            return self.v1_write(body, True)
+        if path == "/crm-associations/v1/associations/delete" and method == "PUT":
+            return self.v1_write(body, False)
+        if path == "/crm/v4/associations/companies/companies/batch/read" and method == "POST":
+            return self.v4_batch_read(body)
+        match = re.fullmatch(r"/crm/v4/objects/companies/(\d+)/associations/companies", path)
+        if match and method == "GET":
+            return self.v4_page(int(match.group(1)), query)
+        if path == "/crm/v4/associations/companies/companies/batch/create" and method == "POST":
+            return self.v4_batch_write(body, True)
+        if path == "/crm/v4/associations/companies/companies/batch/labels/archive" and method == "POST":
+            return self.v4_batch_write(body, False)
+        return 404, {"status": "error", "message": f"Unknown endpoint {method} {path}"}
+
+    def create_unlocked(self):
+        company_id = self.next_company_id
+        self.next_company_id += 1
+        self.merged_into[company_id] = None
+        return company_id
+
+    def get_company(self, company_id):
+        resolved = self.resolve(company_id)
+        if resolved is None:
+            return 404, {"status": "error", "message": "resource not found", "category": "OBJECT_NOT_FOUND"}
+        return 200, {"id": str(resolved), "properties": {"hs_object_id": str(resolved)}}
+
+    def batch_read_companies(self, body):
+        results = {}
+        missing = []
+        for company in body["inputs"]:
+            resolved = self.resolve(company["id"])
+            if resolved is None:
+                missing.append(str(company["id"]))
+                continue
+            results[resolved] = {"id": str(resolved), "properties": {
+                "hs_object_id": str(resolved),
+                "hs_merged_object_ids": ";".join(str(merged_id) for merged_id in self.merged_ids.get(resolved, []))
+            }}
+        response = {"status": "COMPLETE", "results": list(results.values())}
+        if missing:
+            response["errors"] = [{"status": "error", "category": "OBJECT_NOT_FOUND", "message": "Could not get some COMPANY objects",
+                                   "context": {"ids": missing}}]
+            return 207, response
+        return 200, response
+
+    def merge(self, body):
+        source_id, target_id = int(body["objectIdToMerge"]), int(body["primaryObjectId"])
+        if self.resolve(source_id) != source_id or self.resolve(target_id) != target_id:
+            return 400, {"status": "error", "message": "Both companies must exist and not be merged already"}
+        source_parents, target_parents = self.parents.get(source_id, set()), self.parents.get(target_id, set())
+        if source_parents and target_parents and source_parents != target_parents:
+            return 400, {"status": "error", "message": "Cannot merge companies that both have a parent company"}
+        # The source's associations move to the target
+        for child_id in list(self.children.get(source_id, set())):
+            self.set_edge(child_id, source_id, False)
+            if child_id != target_id:
+                self.set_edge(child_id, target_id, True)
+        for parent_id in list(self.parents.get(source_id, set())):
+            self.set_edge(source_id, parent_id, False)
+            if parent_id != target_id:
+                self.set_edge(target_id, parent_id, True)
+        self.merged_into[source_id] = target_id
+        self.merged_ids.setdefault(target_id, []).extend([source_id] + self.merged_ids.pop(source_id, []))
+        return 200, {"id": str(target_id)}
+
+    def v1_associations(self, company_id, definition_id, query):
+        associated = sorted(self.children.get(company_id, ()) if definition_id == CHILD_TYPE_ID else self.parents.get(company_id, ()))
+        limit = int(query.get("limit", ["100"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        remaining = [associated_id for associated_id in associated if associated_id > offset]
+        page = remaining[:limit]
+        return 200, {"results": page, "hasMore": len(remaining) > limit, "offset": page[-1] if page else offset}
+
+    def v1_write(self, body, present):
+        from_id, to_id = body["fromObjectId"], body["toObjectId"]
+        if body["definitionId"] == PARENT_TYPE_ID:
+            self.set_edge(from_id, to_id, present)
+        else:
+            self.set_edge(to_id, from_id, present)
+        return 204, None
+
+    def associations_of(self, company_id):
+        associations = [{"toObjectId": child_id, "associationTypes": [{"category": "HUBSPOT_DEFINED", "typeId": CHILD_TYPE_ID, "label": "Child Company"}]}
+                        for child_id in sorted(self.children.get(company_id, ()))]
+        associations += [{"toObjectId": parent_id, "associationTypes": [{"category": "HUBSPOT_DEFINED", "typeId": PARENT_TYPE_ID, "label": "Parent Company"}]}
+                         for parent_id in sorted(self.parents.get(company_id, ()))]
+        return associations
+
+    def associations_page(self, company_id, after, limit):
+        associations = self.associations_of(company_id)
+        page = {"results": associations[after:after + limit]}
+        if after + limit < len(associations):
+            page["paging"] = {"next": {"after": str(after + limit)}}
+        return page
+
+    def v4_batch_read(self, body):
+        results = []
+        for company in body["inputs"]:
+            company_id = int(company["id"])
+            page = self.associations_page(company_id, 0, self.association_page_size)
+            if page["results"]:
+                result = {"from": {"id": str(company_id)}, "to": page["results"]}
+                if "paging" in page:
+                    result["paging"] = page["paging"]
+                results.append(result)
+        return 200, {"status": "COMPLETE", "results": results}
+
+    def v4_page(self, company_id, query):
+        after = int(query.get("after", ["0"])[0])
+        limit = int(query.get("limit", [str(self.association_page_size)])[0])
+        return 200, self.associations_page(company_id, after, limit)
+
+    def v4_batch_write(self, body, present):
+        for association in body["inputs"]:
+            for association_type in association["types"]:
+                from_id, to_id = association["from"]["id"], association["to"]["id"]
+                if association_type["associationTypeId"] == PARENT_TYPE_ID:
+                    self.set_edge(from_id, to_id, present)
+                else:
+                    self.set_edge(to_id, from_id, present)
+        if present:
+            return 201, {"status": "COMPLETE", "results": []}
+        return 204, None
+
+
+def build_graph(hubspot, keys, fan_out=0, parent_every=10):
+    # Creates a keep and a merge company for every key and returns the input rows.
+    # Both companies get fan_out child companies, and the merge company of every
+    # parent_every-th key gets a parent company, so the key has edges to detach
+    # and reattach.
+    rows = []
+    for key in range(1, keys + 1):
+        keep_id = hubspot.create_company()
+        merge_id = hubspot.create_company()
+        for company_id in (keep_id, merge_id):
+            for _ in range(fan_out):
+                hubspot.associate(hubspot.create_company(), company_id)
+        if parent_every and key % parent_every == 0:
+            hubspot.associate(merge_id, hubspot.create_company())
+        rows.append({"id": str(merge_id), "company_name": f"merge_{key}", "key": str(key), "action": "merge"})
+        rows.append({"id": str(keep_id), "company_name": f"keep_{key}", "key": str(key), "action": "keep"})
+    return rows
+
+
+class MockHubspotServer():
+    # Serves a MockHubspot over HTTP on a local port. GET /__mock__/stats returns
+    # the call counts, for clients running in another process.
+    def __init__(self, hubspot, host="127.0.0.1", port=0):
+        self.hubspot = hubspot
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; without this every response
+            # waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                if self.path == "/__mock__/stats":
+                    status, payload, headers = 200, hubspot.stats(), {}
+                else:
+                    status, payload, headers = hubspot.handle(self.command, self.path, body)
+                data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+        self.server = ThreadingHTTPServer((host, port), RequestHandler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the HubSpot API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--rate-limit", type=int, help="Requests allowed per rate interval before answering 429")
+    parser.add_argument("--rate-interval", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a random 429")
+    parser.add_argument("--keys", type=int, default=0, help="Number of synthetic merge keys to create")
+    parser.add_argument("--fan-out", type=int, default=0, help="Child companies of every synthetic company")
+    parser.add_argument("--input-file", help="Where to write the input CSV of the synthetic keys")
+    args = parser.parse_args()
+
+    hubspot = MockHubspot(latency=args.latency, rate_limit=args.rate_limit, rate_interval=args.rate_interval, error_rate=args.error_rate)
+    rows = build_graph(hubspot, args.keys, args.fan_out)
+    if args.input_file:
+        with open(args.input_file, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, fieldnames=["id", "company_name", "key", "action"])
+            writer.writeheader()
+            writer.writerows(rows)
+    server = MockHubspotServer(hubspot, port=args.port)
+    print(f"Mock HubSpot listening on {server.url}")
+    server.server.serve_forever()
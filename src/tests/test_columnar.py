@@ -0,0 +1,65 @@
+import os
+import sys
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.csv
+import pyarrow.ipc
+import pyarrow.parquet
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root_dir)
+from columnar import ColumnarInput, read_rows
+from validate_csv import ValidateCSV, ValidationError
+
+# Parquet, Arrow IPC and gzip CSV input: the rows grouped by key, and the
+# vectorized validation against ValidateCSV on the same rows.
+
+FIELDS = ("id", "company_name", "key", "action")
+VALID_ROWS = [("1", "a", "1", "keep"), ("3", "c", "2", "merge"), ("2", "b", "1", "MERGE"), ("4", "d", "2", "keep")]
+INVALID_ROWS = [
+    ("1", "a", "1", "keep"), ("2", "b", "1", "merge"), ("2", "b", "1", "merge"),
+    ("3", "c", "2", "keep"), ("4", "d", "2", "remove"),
+    ("5", "e", "3", "keep"), ("1", "a", "3", "merge"),
+    ("6", "f", "4", "keep")
+]
+
+
+def write_input(path, rows):
+    table = pa.table({field: [row[i] for row in rows] for i, field in enumerate(FIELDS)})
+    if path.suffix == ".parquet":
+        pa.parquet.write_table(table, path)
+    elif path.suffix == ".arrow":
+        with pa.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        with pa.CompressedOutputStream(str(path), "gzip") as stream:
+            pa.csv.write_csv(table, stream)
+    return str(path)
+
+
+def errors(input_data):
+    try:
+        ValidateCSV(input_data, max_errors=None)
+    except ValidationError as e:
+        return e.errors
+    return []
+
+
+@pytest.mark.parametrize("name", ["input.parquet", "input.arrow", "input.csv.gz"])
+def test_columnar_input_groups_rows_by_key(tmp_path, name):
+    path = write_input(tmp_path / name, VALID_ROWS)
+    grouped_data = ColumnarInput(path)
+
+    assert list(grouped_data) == ["1", "2"] and grouped_data.row_count == 4
+    assert errors(grouped_data) == []
+    assert [(key, [row["id"] for row in rows]) for key, rows in grouped_data.items()] == [("1", ["1", "2"]), ("2", ["3", "4"])]
+    assert grouped_data["1"][1] == {"id": "2", "company_name": "b", "key": "1", "action": "merge"}
+    assert [row["action"] for row in read_rows(path)] == ["keep", "merge", "merge", "keep"]
+
+
+@pytest.mark.parametrize("name", ["input.parquet", "input.arrow", "input.csv.gz"])
+def test_vectorized_validation_matches_validate_csv(tmp_path, name):
+    grouped_data = ColumnarInput(write_input(tmp_path / name, INVALID_ROWS))
+    expected = errors([dict(zip(FIELDS, row)) for row in INVALID_ROWS])
+    assert expected and errors(grouped_data) == expected
@@ -0,0 +1,51 @@
+import os
+import sys
+import csv
+import json
+import time
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root_dir)
+from main import HubspotAPI
+from coordinator import run_manifest
+from output_writer import read_jsonl
+from mock_hubspot import MockHubspot, MockHubspotServer, build_graph
+
+# A manifest run against the mock HubSpot, interrupted and resumed: the combined
+# outputs come from the resumed run only.
+
+
+def test_resumed_run_combines_each_key_once(tmp_path, monkeypatch):
+    hubspot = MockHubspot()
+    rows = build_graph(hubspot, 6, fan_out=1, parent_every=2)
+    with open(tmp_path / "input.csv", "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=["id", "company_name", "key", "action"])
+        writer.writeheader()
+        writer.writerows(rows)
+    failing_id = next(row["id"] for row in rows if row["key"] == "4" and row["action"] == "merge")
+
+    with MockHubspotServer(hubspot) as server:
+        with open(tmp_path / "manifest.json", "w", encoding="utf-8") as file:
+            json.dump({"jobs": [{"portal": "acme", "token": "test", "input_file": "input.csv", "shards": 2, "base_url": server.url}]}, file)
+        output_dir = str(tmp_path / "portals")
+
+        # The shard processes are forked, so they fail on key 4's merge too
+        merge_company = HubspotAPI.merge_company
+
+        def failing_merge(self, source_company_id, target_company_id):
+            if str(source_company_id) == failing_id:
+                raise Exception("Merge interrupted")
+            return merge_company(self, source_company_id, target_company_id)
+        monkeypatch.setattr(HubspotAPI, "merge_company", failing_merge)
+        summary = run_manifest(str(tmp_path / "manifest.json"), output_dir=output_dir, processes=2)
+        assert len(summary["errors"]) == 1
+        monkeypatch.undo()
+
+        # Output files are named by the second their run started
+        time.sleep(1)
+        summary = run_manifest(str(tmp_path / "manifest.json"), output_dir=output_dir, processes=2, resume=True)
+
+    assert summary["errors"] == [] and summary["portals"]["acme"]["shards"] == 2
+    for prefix in ("pre_merge", "merged"):
+        keys = [record["key"] for record in read_jsonl(summary["portals"]["acme"]["outputs"][prefix])]
+        assert sorted(keys, key=int) == ["1", "2", "3", "4", "5", "6"]
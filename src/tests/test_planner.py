@@ -0,0 +1,92 @@
+import os
+import sys
+import glob
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root_dir)
+from main import HubspotAPI
+from planner import plan_key_associations, count_plan_calls
+from output_writer import read_jsonl
+from mock_hubspot import MockHubspot, MockHubspotServer, build_graph
+
+# The association changes planned for a key, and a --dry-run against the mock
+# HubSpot: the plan file and that nothing is written.
+
+
+def company(company_id, action, child_companies=(), parent_companies=()):
+    return {"id": company_id, "company_name": "", "key": "1", "action": action,
+            "child_companies": list(child_companies), "parent_companies": list(parent_companies)}
+
+
+def edges(plan_edges):
+    return [(str(child_id), str(parent_id)) for child_id, parent_id in plan_edges]
+
+
+def test_plan_moves_merged_children_and_parent():
+    plan = plan_key_associations([
+        company("2", "merge", child_companies=[10, 11], parent_companies=[20]),
+        company("1", "keep", child_companies=[11, 12])
+    ])
+    assert edges(plan["detach"]) == [("10", "2"), ("11", "2"), ("2", "20")]
+    assert plan["merges"] == [("2", "1")]
+    # 11 is already a child of the kept company, so it is not created again
+    assert edges(plan["attach"]) == [("10", "1"), ("1", "20")]
+    assert plan["child_companies"] == [11, 12, 10]
+    assert plan["parent_companies"] == [20]
+    assert count_plan_calls(plan, 1000) == {"detach": 1, "merge": 1, "attach": 1, "total": 3}
+
+
+def test_plan_keeps_the_kept_companys_parent():
+    plan = plan_key_associations([
+        company("2", "merge", parent_companies=[21]),
+        company("1", "keep", parent_companies=[20])
+    ])
+    assert edges(plan["detach"]) == [("2", "21")]
+    assert plan["attach"] == []
+    assert plan["parent_companies"] == [20]
+
+
+def test_plan_detaches_edges_within_the_key():
+    # The merged company is a child of the kept one; after the merge the edge
+    # would point the kept company at itself
+    plan = plan_key_associations([
+        company("2", "merge", parent_companies=["1"]),
+        company("1", "keep", child_companies=["2", 12])
+    ])
+    assert edges(plan["detach"]) == [("2", "1")]
+    assert plan["attach"] == []
+    assert plan["child_companies"] == [12]
+    assert plan["parent_companies"] == []
+
+
+def test_dry_run_plans_without_writing(tmp_path):
+    hubspot = MockHubspot()
+    rows = build_graph(hubspot, 3, fan_out=2, parent_every=2)
+    rows += [{"id": "999", "company_name": "gone", "key": "4", "action": "merge"},
+             {"id": str(hubspot.create_company()), "company_name": "kept", "key": "4", "action": "keep"}]
+    graph = {key: {company_id: set(ids) for company_id, ids in getattr(hubspot, key).items()} for key in ("children", "parents")}
+
+    with MockHubspotServer(hubspot) as server:
+        hubspot_client = HubspotAPI(api_key="test", base_url=server.url, output_dir=str(tmp_path), progress_interval=0)
+        grouped_data = {}
+        for row in rows:
+            grouped_data.setdefault(row["key"], []).append(row)
+        totals = hubspot_client.plan_merge(grouped_data)
+
+    assert {key: getattr(hubspot, key) for key in ("children", "parents")} == graph
+    assert not any(endpoint.endswith(("/merge", "/batch/create", "/batch/labels/archive")) for endpoint in hubspot.calls)
+    assert totals["keys"] == 3 and totals["skipped"] == 1
+    # One company batch read and one association batch read for the window
+    assert totals["read_calls"] == 2
+    assert totals["total"] == 2 + 3 * 3
+
+    plans = {record["key"]: record for record in read_jsonl(glob.glob(str(tmp_path / "outputs" / "plan_*.jsonl"))[0])}
+    assert plans["4"] == {"key": "4", "skipped": True, "missing_company_ids": ["999"]}
+    for key in ("1", "2", "3"):
+        merge_id, keep_id = (row["id"] for row in rows if row["key"] == key)
+        merge_children = sorted(str(child_id) for child_id in hubspot.children[int(merge_id)])
+        merge_parents = [str(parent_id) for parent_id in hubspot.parents.get(int(merge_id), ())]
+        assert edges(plans[key]["detach"]) == [(child_id, merge_id) for child_id in merge_children] + [(merge_id, parent_id) for parent_id in merge_parents]
+        assert edges(plans[key]["merges"]) == [(merge_id, keep_id)]
+        assert edges(plans[key]["attach"]) == [(child_id, keep_id) for child_id in merge_children] + [(keep_id, parent_id) for parent_id in merge_parents]
+        assert plans[key]["calls"] == {"detach": 1, "merge": 1, "attach": 1, "total": 3}
@@ -0,0 +1,94 @@
+import os
+import sys
+import glob
+import pytest
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root_dir)
+from main import HubspotAPI
+from journal import MergeJournal
+from rollback import run_rollback
+from mock_hubspot import MockHubspot, MockHubspotServer, build_graph
+
+# Rollback against the mock HubSpot, from a run's journal and from its pre-merge
+# snapshot.
+
+
+def grouped(rows, keys):
+    grouped_data = {}
+    for key in keys:
+        grouped_data[key] = [row for row in rows if row["key"] == key]
+    return grouped_data
+
+
+def company_ids(rows, key):
+    merge_id, keep_id = (int(row["id"]) for row in rows if row["key"] == key)
+    return merge_id, keep_id
+
+
+def graph(hubspot):
+    return {key: {company_id: set(ids) for company_id, ids in getattr(hubspot, key).items() if ids} for key in ("children", "parents")}
+
+
+def test_rollback_of_a_key_stopped_between_detach_and_merge(tmp_path):
+    hubspot = MockHubspot()
+    rows = build_graph(hubspot, 2, fan_out=3, parent_every=1)
+    before = graph(hubspot)
+    merge_id, keep_id = company_ids(rows, "1")
+
+    with MockHubspotServer(hubspot) as server:
+        hubspot_client = HubspotAPI(api_key="test", base_url=server.url, output_dir=str(tmp_path), progress_interval=0)
+        merge_company = hubspot_client.merge_company
+
+        def failing_merge(source_company_id, target_company_id):
+            if int(source_company_id) == merge_id:
+                raise Exception("Merge interrupted")
+            return merge_company(source_company_id, target_company_id)
+        hubspot_client.merge_company = failing_merge
+
+        journal_path = str(tmp_path / "journal.sqlite")
+        journal = MergeJournal(journal_path)
+        with pytest.raises(Exception, match="Merge interrupted"):
+            # Key 2 is merged, then key 1 stops after its detach
+            hubspot_client.run_merge(grouped(rows, ["2", "1"]), journal=journal)
+        journal.close()
+        assert not hubspot.children.get(merge_id) and not hubspot.parents.get(merge_id)
+
+        summary = run_rollback(journal_path, HubspotAPI(api_key="test", base_url=server.url, output_dir=str(tmp_path), progress_interval=0), workers=2)
+
+    assert summary["restore"] == 4 and summary["conflicts"] == 0 and summary["failed"] == 0
+    # The merge company of key 1 still exists and gets its own children and parent back
+    assert hubspot.children[merge_id] == before["children"][merge_id]
+    assert hubspot.parents[merge_id] == before["parents"][merge_id]
+    assert hubspot.children[keep_id] == before["children"][keep_id]
+    # Key 2 was merged: its merge company's edges are on the kept company
+    merged_id, kept_id = company_ids(rows, "2")
+    assert hubspot.children[kept_id] == before["children"][kept_id] | before["children"][merged_id]
+    assert hubspot.parents[kept_id] == before["parents"][merged_id]
+
+
+def test_rollback_from_snapshot_restores_edges_on_the_surviving_company(tmp_path):
+    hubspot = MockHubspot()
+    rows = build_graph(hubspot, 3, fan_out=2, parent_every=2)
+    before = graph(hubspot)
+
+    with MockHubspotServer(hubspot) as server:
+        hubspot_client = HubspotAPI(api_key="test", base_url=server.url, output_dir=str(tmp_path), progress_interval=0)
+        hubspot_client.run_merge(grouped(rows, ["1", "2", "3"]), collect_results=False)
+        snapshot_path = glob.glob(str(tmp_path / "intermediate" / "pre_merge_*.jsonl"))[0]
+
+        # A later change removes the children of key 1's kept company
+        merge_id, keep_id = company_ids(rows, "1")
+        for child_id in list(hubspot.children[keep_id]):
+            hubspot.set_edge(child_id, keep_id, False)
+
+        hubspot_client = HubspotAPI(api_key="test", base_url=server.url, output_dir=str(tmp_path), progress_interval=0)
+        dry_run = run_rollback(snapshot_path, hubspot_client, workers=2, dry_run=True)
+        assert dry_run["restore"] == 4 and "failed" not in dry_run
+        assert not hubspot.children.get(keep_id)
+        summary = run_rollback(snapshot_path, hubspot_client, workers=2)
+
+    assert summary["restore"] == 4 and summary["conflicts"] == 0 and summary["failed"] == 0
+    # The merge company was merged, so its children come back on the kept company
+    assert hubspot.children[keep_id] == before["children"][keep_id] | before["children"][merge_id]
+    assert merge_id not in hubspot.children or not hubspot.children[merge_id]
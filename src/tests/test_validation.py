@@ -0,0 +1,113 @@
+import io
+import os
+import sys
+import json
+import pytest
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(root_dir)
+from main import HubspotAPI
+from validate_csv import ValidateCSV, ValidationError
+
+# Single-pass validation of --stream input: the rows, keys and rules of the errors,
+# for sorted files (keys closed as they end) and unsorted ones, and of --pipe input.
+
+
+def write_input(path, rows):
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("id,company_name,key,action\n")
+        for row in rows:
+            file.write(",".join(row) + "\n")
+    return str(path)
+
+
+def stream_errors(tmp_path, rows):
+    # (row, key, rule) of every error in the validation report, or [] if the input is valid
+    hubspot_client = HubspotAPI(api_key="test", input_file_path=write_input(tmp_path / "input_data.csv", rows), output_dir=str(tmp_path))
+    try:
+        hubspot_client.iter_grouped_data()
+    except Exception:
+        reports = os.listdir(tmp_path / "errors")
+        with open(tmp_path / "errors" / reports[0], encoding="utf-8") as file:
+            return [(error["row"], error["key"], error["rule"]) for error in json.load(file)]
+    return []
+
+
+def whole_file_errors(rows):
+    try:
+        ValidateCSV([dict(zip(("id", "company_name", "key", "action"), row)) for row in rows])
+    except ValidationError as e:
+        return e.errors
+    return []
+
+
+def test_valid_sorted_input(tmp_path):
+    rows = [("1", "a", "1", "keep"), ("2", "b", "1", "merge"), ("3", "c", "2", "merge"), ("4", "d", "2", "keep")]
+    assert stream_errors(tmp_path, rows) == []
+
+
+def test_sorted_input_errors(tmp_path):
+    rows = [
+        ("1", "a", "1", "keep"), ("2", "b", "1", "merge"), ("2", "b", "1", "merge"),
+        ("3", "c", "2", "keep"), ("4", "d", "2", "remove"),
+        ("5", "e", "3", "keep"), ("1", "a", "3", "merge"),
+        ("6", "f", "4", "keep")
+    ]
+    assert stream_errors(tmp_path, rows) == [
+        (4, "1", "no_duplicate_records"),
+        (None, "1", "merge_mapped_to_single_keep"),
+        (None, "1", "each_key_has_two_records"),
+        (6, "2", "action_has_correct_values"),
+        (None, "2", "merge_mapped_to_single_keep"),
+        (None, "2", "keys_have_merge_and_keep"),
+        (8, "3", "no_keep_merge_id_overlap"),
+        (None, "4", "merge_mapped_to_single_keep"),
+        (None, "4", "each_key_has_two_records"),
+        (None, "4", "keys_have_merge_and_keep")
+    ]
+
+
+def test_duplicates_are_found_within_sorted_keys(tmp_path):
+    # The digests are dropped when a key closes; a repeated row of the open key is still found
+    rows = [("1", "a", "1", "keep"), ("2", "b", "1", "merge"), ("3", "c", "2", "keep"), ("3", "c", "2", "keep"), ("4", "d", "2", "merge")]
+    assert (5, "2", "no_duplicate_records") in stream_errors(tmp_path, rows)
+
+
+def test_unsorted_input_with_split_keys_is_valid(tmp_path):
+    # Key 1 comes back after key 2 was read: its two rows still make one valid key
+    rows = [("1", "a", "1", "keep"), ("3", "c", "2", "keep"), ("4", "d", "2", "merge"), ("2", "b", "1", "merge")]
+    assert stream_errors(tmp_path, rows) == []
+
+
+def test_unsorted_input_errors_match_whole_file_validation(tmp_path):
+    rows = [("1", "a", "2", "keep"), ("2", "b", "1", "merge"), ("3", "c", "1", "keep"), ("4", "d", "2", "keep"), ("1", "a", "2", "keep")]
+    assert stream_errors(tmp_path, rows) == [(error["row"], error["key"], error["rule"]) for error in whole_file_errors(rows)]
+
+
+def test_closed_keys_release_their_digests():
+    validator = ValidateCSV()
+    for row_number, key in enumerate(["1", "1", "2", "2"], start=2):
+        validator.add({"id": str(row_number), "company_name": "", "key": key, "action": "keep" if row_number % 2 else "merge"}, row_number)
+        if row_number % 2:
+            validator.close_key(key)
+            assert not validator.seen_records
+    assert validator.row_count == 4
+    with pytest.raises(ValidationError):
+        ValidateCSV([{"id": "1", "company_name": "", "key": "1", "action": "keep"}])
+
+
+def test_pipe_key_with_three_rows_is_invalid(tmp_path):
+    # The third row belongs to the key as well; its first two rows are not merged on their own
+    rows = [("1", "a", "1", "keep"), ("2", "b", "1", "merge"), ("3", "c", "1", "merge"), ("4", "d", "2", "keep"), ("5", "e", "2", "merge")]
+    stream = io.StringIO("id,company_name,key,action\n" + "".join(",".join(row) + "\n" for row in rows))
+    records = []
+
+    class Output():
+        def write(self, record):
+            records.append(record)
+    hubspot_client = HubspotAPI(api_key="test", output_dir=str(tmp_path), progress_interval=0)
+    windows = list(hubspot_client.read_stream_groups(stream, Output()).windows(10))
+
+    assert [key for window in windows for key, companies in window] == ["2"]
+    assert [record["key"] for record in records] == ["1"]
+    assert {error["rule"] for error in records[0]["validation_errors"]} == {"each_key_has_two_records", "merge_mapped_to_single_keep"}
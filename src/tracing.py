@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+from metrics import endpoint_name
+
+
+class Tracer():
+    # Records spans (keys, phases, lock waits) and the HTTP calls made inside them,
+    # and writes them in the Chrome trace event format, which chrome://tracing,
+    # Perfetto and speedscope open. Each worker thread gets its own track, so
+    # overlapping keys and stalls show up side by side. Every span also records how
+    # much of its time was spent waiting on HTTP calls (network_seconds) and how
+    # much was local work (local_seconds).
+    def __init__(self, max_events=1000000):
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events = []
+        self.dropped = 0
+        self.thread_ids = {}
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+
+    def thread_id(self):
+        ident = threading.get_ident()
+        thread_id = self.thread_ids.get(ident)
+        if thread_id is None:
+            with self.lock:
+                thread_id = self.thread_ids[ident] = len(self.thread_ids) + 1
+                self.events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread_id,
+                                    "args": {"name": threading.current_thread().name}})
+        return thread_id
+
+    def add_event(self, name, category, start, seconds, args):
+        event = {"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": self.thread_id(),
+                 "ts": round((start - self.start) * 1000000, 1), "dur": round(seconds * 1000000, 1), "args": args}
+        with self.lock:
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+            else:
+                self.dropped += 1
+
+    @contextmanager
+    def span(self, name, category="phase", **args):
+        stack = self.local.__dict__.setdefault("stack", [])
+        span = {"network_seconds": 0.0}
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            # Calls made in parallel by helper threads (see bind) can add up to more
+            # network time than the span lasted
+            args.update(network_seconds=round(span["network_seconds"], 6), local_seconds=round(max(0.0, seconds - span["network_seconds"]), 6))
+            self.add_event(name, category, start, seconds, args)
+
+    def bind(self, function):
+        # For work handed to another thread (prefetched pages, parallel batches): its
+        # HTTP calls count towards the spans open on the thread that handed it over
+        stack = list(getattr(self.local, "stack", []))
+
+        def bound(*args, **kwargs):
+            previous = getattr(self.local, "stack", [])
+            self.local.stack = list(stack)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.stack = previous
+        return bound
+
+    def on_response(self, method, path, status_code, seconds, attempt=1):
+        # Transport listener: the call has just finished, so it started seconds ago.
+        # Spans can be shared with helper threads, so they are updated under the lock.
+        with self.lock:
+            for span in getattr(self.local, "stack", []):
+                span["network_seconds"] += seconds
+        self.add_event(endpoint_name(method, path), "http", time.perf_counter() - seconds, seconds,
+                       {"path": path, "status": status_code})
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms",
+                     "otherData": {"dropped_events": self.dropped}}
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(trace, file, separators=(",", ":"))
+        if self.dropped:
+            logging.info(f"Trace is missing {self.dropped} events beyond the first {self.max_events}")
+        logging.info(f"Wrote {len(trace['traceEvents'])} trace events to {path}")
+
+
+@contextmanager
+def profiled(path, top=30):
+    # Runs the block under cProfile and writes the stats to path, for snakeviz,
+    # gprof2dot or flameprof. Threads started inside the block (the merge workers)
+    # get their own profiler, and all of them are added up at the end.
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    profiles = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def profile_thread(frame, event, arg):
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 and later profile every thread with the first profiler
+            return
+        with lock:
+            profiles.append(profile)
+
+    threading.setprofile(profile_thread)
+    profiles[0].enable()
+    try:
+        yield
+    finally:
+        profiles[0].disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(path)
+        logging.info(f"Wrote profile of {len(profiles)} threads to {path}")
+        top_functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+        for (file_name, line, function), (_, calls, own_seconds, cumulative_seconds, _) in top_functions:
+            logging.info(f"Profile: {cumulative_seconds:8.3f}s cumulative {own_seconds:8.3f}s own {calls:>8} calls  {function} ({os.path.basename(file_name)}:{line})")
@@ -0,0 +1,87 @@
+import time
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HubspotTransport():
+    def __init__(self, access_token, base_url="https://api.hubapi.com", pool_size=10, connect_timeout=5, read_timeout=30, gzip=True, rate_limiter=None, listeners=None, governor=None):
+        self.base_url = base_url.rstrip("/")
+        # Anything with an acquire() method that blocks until a request may be sent,
+        # e.g. a rate limit shared with other processes using the same token
+        self.rate_limiter = rate_limiter
+        # Paces requests and retries throttled and failed ones; see rate_governor.py
+        self.governor = governor
+        # Called after every request with (method, path, status_code, seconds, attempt);
+        # status_code is None if the request failed without a response
+        self.listeners = list(listeners or [])
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate" if gzip else "identity",
+            "Connection": "keep-alive"
+        })
+        # One pool per host; pool_maxsize is the number of connections kept alive
+        # for api.hubapi.com, so it should be at least the number of workers
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 1
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            sent_at = self.governor.acquire() if self.governor else None
+            start = time.perf_counter()
+            response = None
+            try:
+                try:
+                    response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+                finally:
+                    # The slot is given back however the call ends, including errors
+                    # that are not a RequestException
+                    if self.governor and response is not None:
+                        self.governor.release(sent_at, response.status_code, response.headers)
+                    elif self.governor:
+                        self.governor.release(sent_at)
+            except requests.RequestException as e:
+                self.notify(method, path, None, time.perf_counter() - start, attempt)
+                if not self.governor:
+                    raise
+                delay = self.governor.retry_delay(method, path, None, attempt)
+                if delay is None:
+                    raise
+                logging.warning(f"{method} {path} failed ({e}); retrying in {delay:.1f}s")
+            else:
+                self.notify(method, path, response.status_code, time.perf_counter() - start, attempt)
+                if not self.governor:
+                    return response
+                delay = self.governor.retry_delay(method, path, response.status_code, attempt, response.headers)
+                if delay is None:
+                    return response
+                logging.warning(f"{method} {path} returned {response.status_code}; retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, method, path, status_code, seconds, attempt=1):
+        for listener in self.listeners:
+            listener(method, path, status_code, seconds, attempt)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        self.session.close()
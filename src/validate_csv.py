@@ -1,102 +1,152 @@
 import logging
+import hashlib
+from records import RecordStore, parse_company_id
+from columnar import ColumnarInput
+
+class ValidationError(ValueError):
+    def __init__(self, message, errors):
+        super().__init__(message)
+        self.errors = errors
 
 class ValidateCSV():
-    def __init__(self, input_data):
+    # All rules are checked in a single pass: add() updates the row rules as each
+    # record arrives, and the per-key rules are checked when a key is closed (for
+    # input grouped by key) or at finish(). A duplicate row has the same key, so once
+    # no key is open the row digests are dropped, and input whose keys are closed as
+    # they end is validated in memory that does not grow with its keys. Row numbers
+    # count the header as row 1.
+    # With allow_chains, a company may be merged in one key and kept in another, so
+    # pairs can later be grouped into merge clusters. A RecordStore is validated key
+    # by key from its columns (see validate_store), and a ColumnarInput with Arrow
+    # compute functions (see columnar.py).
+    def __init__(self, input_data=None, max_errors=100, allow_chains=False):
         self.input_data = input_data
-        self.validate_csv()
+        self.max_errors = max_errors
+        self.allow_chains = allow_chains
+        self.errors = []
+        self.error_count = 0
+        self.row_count = 0
+        self.seen_records = set()
+        self.keep_ids = set()
+        self.merge_ids = set()
+        self.key_counts = {}
+        if isinstance(input_data, RecordStore):
+            self.validate_store(input_data)
+        elif isinstance(input_data, ColumnarInput):
+            self.validate_columns(input_data)
+        elif input_data is not None:
+            self.validate_csv()
 
     def validate_csv(self):
-        self.validate_csv__no_duplicate_records(self.input_data)
-        self.validate_csv__no_keep_merge_id_overlap(self.input_data)
-        self.validate_csv__merge_mapped_to_single_keep(self.input_data)
-        self.validate_csv__each_key_has_two_records(self.input_data)
-        self.validate_csv__keys_have_merge_and_keep(self.input_data)
-        self.validate_csv__action_has_correct_values(self.input_data)
+        for row_number, record in enumerate(self.input_data, start=2):
+            self.add(record, row_number)
+        self.finish()
+
+    def validate_store(self, store):
+        # The store already has the rows of each key together, so duplicate rows can
+        # only be within a key and the per-key counts come from its action column;
+        # nothing is kept per row or per key
+        for key, start, end in store.key_ranges():
+            seen_records = set()
+            for record in store.records(start, end, key):
+                normalized = tuple(str(value).strip() for field, value in record.items())
+                if normalized in seen_records:
+                    self.report("no_duplicate_records", f"Duplicate record found: {record}", key, record.row_number)
+                seen_records.add(normalized)
+                self.validate_csv__action_has_correct_values(record, record.row_number)
+                if not self.allow_chains:
+                    self.validate_csv__no_keep_merge_id_overlap(record, record.row_number)
+            counts = store.action_counts(start, end)
+            self.validate_csv__merge_mapped_to_single_keep(key, counts)
+            self.validate_csv__each_key_has_two_records(key, counts)
+            self.validate_csv__keys_have_merge_and_keep(key, counts)
+        self.raise_if_invalid()
         logging.info('Input data has been validated')
 
-    def validate_csv__no_duplicate_records(self, data):
-        seen = set()
-        for record in data:
-            record_tuple = tuple(record.items())
-            if record_tuple in seen:
-                error_message = f"Duplicate record found: {record}"
-                logging.error(error_message) 
-                raise ValueError(error_message)
-            seen.add(record_tuple)
-
-    def validate_csv__no_keep_merge_id_overlap(self, data):
-        keep_ids = set()
-        merge_ids = set()
-
-        for record in data:
-            action = record['action']
-            company_id = record['id']
-
-            if action == 'keep':
-                if company_id in merge_ids:
-                    error_message = f"ID {company_id} is used as 'merge' in another key."
-                    logging.error(error_message) 
-                    raise ValueError(error_message)
-                keep_ids.add(company_id)
-            elif action == 'merge':
-                if company_id in keep_ids:
-                    error_message = f"ID {company_id} is used as 'keep' in another key."
-                    logging.error(error_message) 
-                    raise ValueError(error_message)
-                merge_ids.add(company_id)
-
-    def validate_csv__merge_mapped_to_single_keep(self, data):
-        key_action_count = {}
-
-        for record in data:
-            key = record['key']
-            action = record['action']
-
-            if key not in key_action_count:
-                key_action_count[key] = {'keep': 0, 'merge': 0}
-            key_action_count[key][action] += 1
-
-        for key, actions in key_action_count.items():
-            if actions['merge'] != 1 or actions['keep'] != 1:
-                error_message = f"Key {key} does not map one 'merge' to exactly one 'keep' (found {actions['merge']} merge and {actions['keep']} keep)."
-                logging.error(error_message) 
-                raise ValueError(error_message)
-
-    def validate_csv__each_key_has_two_records(self, data):
-        key_counts = {}
-
-        for record in data:
-            key = record['key']
-            key_counts[key] = key_counts.get(key, 0) + 1
-
-        for key, count in key_counts.items():
-            if count != 2:
-                error_message = f"Key {key} does not have exactly two records (found {count})."
-                logging.error(error_message) 
-                raise ValueError(error_message)
-
-
-    def validate_csv__keys_have_merge_and_keep(self, data):
-        key_actions = {}
-        for record in data:
-            key = record['key']
-            action = record['action']
-            if key not in key_actions:
-                key_actions[key] = set()
-            key_actions[key].add(action)
-
-        for key, actions in key_actions.items():
-            if actions != {"merge", "keep"}:
-                error_message = f"Key {key} does not have both 'merge' and 'keep' actions."
-                logging.error(error_message) 
-                raise ValueError(error_message)
-
-    def validate_csv__action_has_correct_values(self, data):
-        valid_actions = {"merge", "keep"}
-        for record in data:
-            action = record['action']
-            if action not in valid_actions:
-                error_message = f"Invalid action '{action}' in record: {record}"
-                logging.error(error_message) 
-                raise ValueError(error_message)
+    def validate_columns(self, columns):
+        columns.validate(self)
+        self.raise_if_invalid()
+        logging.info('Input data has been validated')
 
+    def add(self, record, row_number=None):
+        self.row_count += 1
+        self.validate_csv__no_duplicate_records(record, row_number)
+        self.validate_csv__action_has_correct_values(record, row_number)
+        if not self.allow_chains:
+            self.validate_csv__no_keep_merge_id_overlap(record, row_number)
+
+        counts = self.key_counts.setdefault(record['key'], {'keep': 0, 'merge': 0, 'rows': 0})
+        counts['rows'] += 1
+        if record['action'] in ('keep', 'merge'):
+            counts[record['action']] += 1
+
+    def close_key(self, key):
+        counts = self.key_counts.pop(key, None)
+        if counts is not None:
+            self.validate_csv__merge_mapped_to_single_keep(key, counts)
+            self.validate_csv__each_key_has_two_records(key, counts)
+            self.validate_csv__keys_have_merge_and_keep(key, counts)
+        if not self.key_counts:
+            self.seen_records.clear()
+
+    def finish(self):
+        for key in list(self.key_counts):
+            self.close_key(key)
+        self.raise_if_invalid()
+        logging.info('Input data has been validated')
+
+    def raise_if_invalid(self):
+        if not self.errors:
+            return
+        error_message = self.errors[0]['message']
+        if self.error_count > 1:
+            error_message = f"{error_message} ({self.error_count - 1} more errors, see the validation report)"
+        raise ValidationError(error_message, self.errors)
+
+    def report(self, rule, message, key=None, row_number=None):
+        self.error_count += 1
+        if self.max_errors is None or len(self.errors) < self.max_errors:
+            logging.error(message)
+            self.errors.append({"row": row_number, "key": key, "rule": rule, "message": message})
+
+    def validate_csv__no_duplicate_records(self, record, row_number=None):
+        # Rows are compared by a digest of their normalized values, so only 16 bytes
+        # per row are kept
+        normalized = "\x1f".join(f"{field}={str(value).strip()}" for field, value in sorted(record.items()))
+        digest = hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+        if digest in self.seen_records:
+            self.report("no_duplicate_records", f"Duplicate record found: {record}", record['key'], row_number)
+        self.seen_records.add(digest)
+
+    def validate_csv__no_keep_merge_id_overlap(self, record, row_number=None):
+        action = record['action']
+        company_id = record['id']
+        # Numeric ids are kept as ints, which take half the memory
+        stored_id = parse_company_id(company_id)
+
+        if action == 'keep':
+            if stored_id in self.merge_ids:
+                self.report("no_keep_merge_id_overlap", f"ID {company_id} is used as 'merge' in another key.", record['key'], row_number)
+            self.keep_ids.add(stored_id)
+        elif action == 'merge':
+            if stored_id in self.keep_ids:
+                self.report("no_keep_merge_id_overlap", f"ID {company_id} is used as 'keep' in another key.", record['key'], row_number)
+            self.merge_ids.add(stored_id)
+
+    def validate_csv__merge_mapped_to_single_keep(self, key, counts):
+        if counts['merge'] != 1 or counts['keep'] != 1:
+            self.report("merge_mapped_to_single_keep", f"Key {key} does not map one 'merge' to exactly one 'keep' (found {counts['merge']} merge and {counts['keep']} keep).", key)
+
+    def validate_csv__each_key_has_two_records(self, key, counts):
+        if counts['rows'] != 2:
+            self.report("each_key_has_two_records", f"Key {key} does not have exactly two records (found {counts['rows']}).", key)
+
+    def validate_csv__keys_have_merge_and_keep(self, key, counts):
+        if not counts['merge'] or not counts['keep']:
+            self.report("keys_have_merge_and_keep", f"Key {key} does not have both 'merge' and 'keep' actions.", key)
+
+    def validate_csv__action_has_correct_values(self, record, row_number=None):
+        valid_actions = {"merge", "keep"}
+        action = record['action']
+        if action not in valid_actions:
+            self.report("action_has_correct_values", f"Invalid action '{action}' in record: {record}", record['key'], row_number)